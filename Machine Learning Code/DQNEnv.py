@@ -97,11 +97,18 @@ class DQAgent(object):
         if np.random.random() < self.epsilon:                                          
             action = np.random.choice(np.arange(self.n_actions))
         else:
-            state = torch.tensor([state], dtype = torch.float32).to(self.q.device)        #make state a tensor and add batch dimension
+            state = torch.from_numpy(np.asarray(state, dtype = np.float32)).unsqueeze(0).to(self.q.device) #wrap the float32 observation (no copy) and add batch dimension
             q = self.q.forward(state)                                                      #forward pass
             action = torch.argmax(q)                                                      #selection action with highest q value
         return int(action)
 
+    def choose_actions(self, states):   #Epsilon greedy action selection for a batch of states
+        states = torch.from_numpy(np.asarray(states, dtype = np.float32)).to(self.q.device)
+        actions = torch.argmax(self.q.forward(states), axis = 1).cpu().numpy()
+        explore = np.random.random(len(actions)) < self.epsilon
+        actions[explore] = np.random.choice(np.arange(self.n_actions), explore.sum())
+        return actions
+
     def learn(self) -> None:
         if self.replay_buffer.mem_counter < self.min_memory_for_training:
             return
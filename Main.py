@@ -1,13 +1,16 @@
 import sys
+import copy
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from pymgrid import MicrogridGenerator as mg
+from pymgrid.Microgrid import VecMicrogrid
 import numpy as np
-from Storage import StorageSuite
+import pandas as pd
+from Storage import StorageSuite, check_device_data
 from DQNEnv import DQAgent # Neural Net implimentation module
 import pickle as pkl # Neural Network storage and loading
 from scipy.optimize import minimize
 from scipy.optimize import LinearConstraint
-import ast
-import operator as op
 from IPython.display import display, clear_output
 from time import sleep
 
@@ -16,29 +19,9 @@ DAY = 96 # Number of 15 Min intervals in day
 MONTH = 2_924 # Number of 15 Min intervals in month
 YEAR =35_088 # Number of 15 Min intervals in year (non-leap)
 ZERO = 10**-5 # Low value for zeroes
-
-############
-''' the following is a string -> evaluation parser '''
-operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
-             ast.Div: op.truediv, ast.Pow: op.pow, ast.BitXor: op.xor,
-             ast.USub: op.neg}
-
-def eval_expr(expr) -> float :
-    if expr != '':
-        return eval_(ast.parse(expr, mode='eval').body)
-    else:
-        return None
-
-def eval_(node) -> float:
-    if isinstance(node, ast.Num): # <number>
-        return node.n
-    elif isinstance(node, ast.BinOp): # <left> <operator> <right>
-        return operators[type(node.op)](float(eval_(node.left)), float(eval_(node.right)))
-    elif isinstance(node, ast.UnaryOp): # <operator> <operand> e.g., -1
-        return operators[type(node.op)](eval_(node.operand))
-    else:
-        raise TypeError(node)
-############
+DATA_PATH = Path(__file__).parent / 'data' # storage device behavior data files
+RECORD_KEYS = ('df_actions', 'df_status', 'df_actual_generation', 'df_cost', 'df_co2') # per run records of a microgrid_spec
+CATALOG_DEVICES = ('li-ion', 'flow', 'flywheel') # storage devices of every version in compare_catalog_versions
 
 class GridOptimizer:
     ''' This will create the microgrids, train and test a neural network and optimize the scale of the network
@@ -54,6 +37,9 @@ class GridOptimizer:
             - self.ss: StorageSuite object, contains all storage device parameters
             - self.device_cost_list: list, contains list of all device capital costs
             - self.constratint: Scipy LinearContraint object, used for function minimization
+            - self.param_order: list, index in the (L, F, W) parameters of each device of self.ss, in registry order
+            - self.baseline_caps: np.ndarray, (L, F, W) capacities of the baseline storage suite
+            - self.score_gradient: np.ndarray, gradient of the score at self.score_params, from the last score_contraint run
             '''
     def __init__(self, data_path: str, cost_limit: float):
         self.data_path = data_path
@@ -61,48 +47,114 @@ class GridOptimizer:
         self.ss = StorageSuite(filename=self.data_path, load = 600_000) # Create baseline storage suite
         self.li_battery, self.flow_battery, self.flywheel = self.ss.unpack()
         self.device_cost_list = [self.li_battery.capital_cost, self.flow_battery.capital_cost, self.flywheel.capital_cost]
+        self.baseline_caps = np.array([self.li_battery.cap, self.flow_battery.cap, self.flywheel.cap])
+        self.param_order = [('li-ion', 'flow', 'flywheel').index(device) for device in self.ss.storage_suite]
         ### Create initial grid
         self.mg_gen = mg.MicrogridGenerator(storage_suite_list=[self.ss])
         self.mg_gen.generate_microgrid(verbose=False, interpolate=True)
         self.initial_grid_env = self.mg_gen.microgrids[0]
 
+    def registry_caps(self, params):
+        ''' Reorders (L, F, W) capacities, or an array of them along the last axis, into StorageSuite registry order '''
+        return np.asarray(params, dtype=float)[..., self.param_order]
+
+    def total_capital_cost(self, params):
+        ''' Total storage capital cost of (L, F, W) capacities, vectorized over leading axes '''
+        return self.ss.capital_cost_surface(self.registry_caps(params))['total']
+
+    def capital_cost_jac(self, params):
+        ''' Gradient of total_capital_cost with respect to the (L, F, W) capacities '''
+        gradient = np.empty(np.shape(params))
+        gradient[..., self.param_order] = self.ss.capital_cost_gradient(self.registry_caps(params))
+        return gradient
+
     def inequality_constraint1(self, params):
-        L = params[0]
-        F = params[1]
-        W = params[2]        
-        cap_cost_formula = self.ss.get_total_capital_cost_formula().replace("L", str(L/1000)).replace("F", str(F/1000)).replace("W", str(W/1000))
-        return self.cost_limit - eval_expr(cap_cost_formula) 
+        return self.cost_limit - self.total_capital_cost(params)
     
     def inequality_constraint2(self, params):
-        L = params[0]
-        F = params[1]
-        W = params[2]        
-        cap_cost_formula = self.ss.get_total_capital_cost_formula().replace("L", str(L/1000)).replace("F", str(F/1000)).replace("W", str(W/1000))
-        return eval_expr(cap_cost_formula) - (self.cost_limit - 700_000)
+        return self.total_capital_cost(params) - (self.cost_limit - 700_000)
+
+    def inequality_constraint1_jac(self, params):
+        return -self.capital_cost_jac(params)
+
+    def inequality_constraint2_jac(self, params):
+        return self.capital_cost_jac(params)
 
 
     def score_contraint(self, params):
-        # L = params[0]
-        # F = params[1]
-        # W = params[2]
-        # cap_cost_formula = self.ss.get_total_capital_cost_formula().replace("L", str(L/1000)).replace("F", str(F/1000)).replace("W", str(W/1000))
         # Create New grid with new values to test #
-        self.ss.modify_ss(params)
+        self.ss.modify_ss(self.registry_caps(params))
+        self.ss.track_sensitivity() # derivatives of the run with respect to each capacity, for score_contraint_jac
         new_grid_gen = mg.MicrogridGenerator(storage_suite_list=[self.ss])
         new_grid_gen.generate_microgrid(verbose=False, interpolate=True)
         new_grid_env = new_grid_gen.microgrids[0]
-        self.new_score = self.test_grid(env = new_grid_env, horizon=YEAR, load_path=r"C:\Users\thesu\Desktop\Design\Agents\Trained Agent Object.pkl")
+        self.new_score, gradient = self._score_episode(env = new_grid_env, horizon=YEAR, agent = self.agent)
+        new_grid_env.reset()
+        self.score_params = np.array(params, dtype=float)
+        self.score_gradient = np.empty(len(self.param_order))
+        self.score_gradient[self.param_order] = gradient
         # sys.stdout.write(f'\rNew score: {new_score}, Score percentage: {(new_score/self.initial_score)*100}%\n')#, Score is: {final}')
         # sys.stdout.flush()         
         return self.new_score - (0.95*self.initial_score) # Score must be no less than 95% of initial score
-        
+
+    def score_contraint_jac(self, params):
+        ''' Gradient of score_contraint from the capacity sensitivities of the same simulation, no extra runs
+            unless params differ from the last score_contraint call '''
+        if not np.array_equal(params, self.score_params):
+            self.score_contraint(params)
+        return self.score_gradient
+
+    @staticmethod
+    def _score_episode(env: object, horizon: int, agent: object) -> tuple:
+        ''' Runs one episode like run_episode and returns its score with the derivative of the score with respect
+            to the capacity of each device of env.ss, in registry order. The devices must track their sensitivity.
+
+            With the actions of the agent held fixed, a capacity only moves the energy its device takes from
+            and gives to the microgrid, so each step changes pv_required by d(used - requested) / step hours.
+            That costs cost_loss_load per W in a loss load step and -cost_overgeneration / 4000 per W in an
+            overgeneration step; steps that meet the demand or curtail pv do not change. The reward is the
+            cost / 4000. A command that actions_agent limits to the power or the stored energy of its device
+            moves with the capacity, actions_agent passes that derivative on to the sensitivity of the device. '''
+        env.set_horizon(horizon = horizon)
+        cost_loss_load = env.parameters['cost_loss_load'].values[0]
+        cost_overgeneration = env.parameters['cost_overgeneration'].values[0]
+        production = env._df_record_actual_production
+        state = env.reset(copy = False)
+        sensitivities = [device.sensitivity for device in env.ss.devices] # reset starts them again
+        score = 0
+        done = 0
+        gradient = np.zeros(len(sensitivities))
+        previous = np.zeros(len(sensitivities))
+        while not done:
+            action = env.actions_agent(action = agent.choose_action(state))
+            state, reward, done = env.run(action, copy = False)
+            score += reward
+            net = np.array([sensitivity.dused - sensitivity.drequested for sensitivity in sensitivities])
+            if production['loss_load'][-1] > 0: # pv_required above the pv available
+                gradient += cost_loss_load * (net - previous) / env._step_hours
+            elif production['overgeneration'][-1] > 0: # pv_required below 0
+                gradient -= cost_overgeneration / 4_000 * (net - previous) / env._step_hours
+            previous = net
+        return score, gradient / 4_000
+
+    def check_score_gradient(self, params = None, step: float = None) -> dict:
+        ''' Compares score_contraint_jac at the (L, F, W) capacities params with central finite differences of
+            score_contraint, two more simulations per capacity. params defaults to self.baseline_caps, where the power of
+            the devices limits the discharge commands of actions_agent. step defaults to 1e-4 of
+            each capacity. Returns the two gradients and their largest absolute difference. '''
+        params = np.asarray(self.baseline_caps if params is None else params, dtype=float)
+        steps = 1e-4 * np.maximum(np.abs(params), 1.0) if step is None else np.full(params.shape, float(step))
+        gradient = np.array(self.score_contraint_jac(params), dtype=float)
+        finite = np.empty(params.shape)
+        for idx, h in enumerate(steps):
+            shift = np.zeros(params.shape)
+            shift[idx] = h
+            finite[idx] = (self.score_contraint(params + shift) - self.score_contraint(params - shift)) / (2 * h)
+        return {'gradient': gradient, 'finite_difference': finite, 'max_error': float(np.max(np.abs(gradient - finite)))}
+
 
     def cap_function(self, params: list):
-        L = params[0]
-        F = params[1]
-        W = params[2]        
-        cap_cost_formula = self.ss.get_total_capital_cost_formula().replace("L", str(L/1000)).replace("F", str(F/1000)).replace("W", str(W/1000))
-        final = (eval_expr(cap_cost_formula))
+        final = float(self.total_capital_cost(params))
         sys.stdout.write(f'\rScore percentage: {(self.new_score/self.initial_score)*100}%, params: {params}')
         sys.stdout.flush()     
         # sys.stdout.write(f'\r{params}')#, Score is: {final}')
@@ -113,18 +165,20 @@ class GridOptimizer:
         return self.ss.get_total_capital_cost_formula()
 
     def start_minimize(self):
-        cons1 = ({"type":"ineq","fun": self.inequality_constraint1})
-        cons2 = ({"type":"ineq","fun": self.inequality_constraint2})
-        cons3 = ({"type":"ineq","fun": self.score_contraint})
+        cons1 = ({"type":"ineq","fun": self.inequality_constraint1, "jac": self.inequality_constraint1_jac})
+        cons2 = ({"type":"ineq","fun": self.inequality_constraint2, "jac": self.inequality_constraint2_jac})
+        cons3 = ({"type":"ineq","fun": self.score_contraint, "jac": self.score_contraint_jac})
         constraints = [cons1, cons2, cons3]
         self.new_score = 0
+        self.score_params = None
         bnds = (0,None)
         with open(r"C:\Users\thesu\Desktop\Design\Agents\Trained Agent Object.pkl", 'rb') as f:  # Loads agent from desired path
-            trained_agent = pkl.load(f)
-        self.initial_score = self.test_grid(env = self.initial_grid_env, horizon=YEAR, agent = trained_agent)
+            self.agent = pkl.load(f)
+        self.initial_score = self.test_grid(env = self.initial_grid_env, horizon=YEAR, agent = self.agent)
         print(self.initial_score)
         initial_guess = [self.li_battery.cap, self.flow_battery.cap, self.flywheel.cap]               
-        optimized_function = minimize(fun = self.cap_function, x0 = initial_guess, method='trust-constr', constraints=constraints, bounds = (bnds, bnds, bnds))
+        optimized_function = minimize(fun = self.cap_function, x0 = initial_guess, jac = self.capital_cost_jac, method='trust-constr',
+                                      constraints=constraints, bounds = (bnds, bnds, bnds))
         return optimized_function
 
     def train_new_network(self, env: object, n_episodes: int, nb_actions: int, horizon: int, store_path: None) -> object:
@@ -169,12 +223,20 @@ class GridOptimizer:
 
     def test_grid(self, env: object, horizon: int, agent: object) -> float:
         ''' Manages the grid based on a trained neural net model '''
+        score = self.run_episode(env = env, horizon = horizon, agent = agent)['score']
+        env.reset()                                                                    
+        return score
+
+    @staticmethod
+    def run_episode(env: object, horizon: int, agent: object) -> dict:
+        ''' Runs one episode of a trained agent on env and returns its score, total cost and co2.
+            The records of the episode are left in env. '''
         env.set_horizon(horizon = horizon) # Sets the Horizon
 
         # with open(load_path, 'rb') as f:  # Loads agent from desired path
         #     agent = pkl.load(f)
 
-        state = env.reset()                                                       
+        state = env.reset(copy = False) # the observation buffer, only read by the agent before the next step
         score = 0                                                                   
         done = 0
 
@@ -182,13 +244,95 @@ class GridOptimizer:
         while not done:                                                                                         
             action_select = agent.choose_action(state)
             action = env.actions_agent(action = action_select) 
-            new_state,reward, done, = env.run(action)                             
+            new_state,reward, done, = env.run(action, copy = False)                             
             score+=reward                                                                                                                   
             state = new_state
             # value_print="\rProgress " + str(round(((env._tracking_timestep)*100)/(env.horizon),1)) +" %"
             # sys.stdout.write(value_print)
             # sys.stdout.flush()                                                       
-        env.reset()                                                                    
-        return score
+        return {'score': score,
+                'cost': float(np.sum(env._df_record_cost['total_cost'])),
+                'co2': float(np.sum(env._df_record_co2['co2']))}
+
+
+    def test_sizings(self, env: object, caps, horizon: int, agent: object) -> dict:
+        ''' Runs one episode of a trained agent on env for every row of (L, F, W) capacities in caps, all at once.
+            Returns the score, total cost and co2 of each sizing as arrays. '''
+        env.set_horizon(horizon = horizon)
+        vec_env = VecMicrogrid(env, caps = self.registry_caps(caps))
+        states = vec_env.reset()
+        score = np.zeros(vec_env.n)
+        while not vec_env.done.all():
+            states, reward, done = vec_env.step(agent.choose_actions(states))
+            score += reward
+        return {'score': score, 'cost': vec_env.total_cost, 'co2': vec_env.total_co2}
+
+
+def compare_catalog_versions(agent: object, data_paths: list = None, horizon: int = YEAR, load: float = 600_000,
+                             devices: list = CATALOG_DEVICES, caps: list = None, max_workers: int = None) -> pd.DataFrame:
+    ''' Runs the same microgrid scenario and agent with a StorageSuite built from each storage device data file
+        and returns a table of score, cost, co2 and storage capital cost per data file version.
+        Every version gets the same devices with the same capacities, caps in the order of devices (the load
+        split evenly by default), so that only the device data differs.
+        The scenario is generated once and sent once to every worker process of the pool.
+        Defaults to the data/energy_storage_devices*.csv files that fit devices, see loadable_catalog_versions.
+        A version whose data does not fit the devices (ValueError or KeyError) gets its error in the error column
+        instead of stopping the comparison; any other error stops it. '''
+    devices = list(devices)
+    if data_paths is None:
+        data_paths = loadable_catalog_versions(devices)
+    if not data_paths:
+        raise ValueError(f"No storage device data file has the devices {devices}")
+    if caps is None:
+        caps = [load / len(devices)] * len(devices)
+    baseline = StorageSuite(filename=data_paths[-1], load=load, devices=devices) # only sizes the scenario
+    baseline.resize(caps, reset_state=True)
+    scenario = mg.MicrogridGenerator(storage_suite_list=[baseline])._create_microgrid_spec(idx=0)
+    del scenario['storage_suite'] # rebuilt from each data file in the workers
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_comparison_worker,
+                             initargs=(scenario, agent, horizon, load, devices, list(caps))) as pool:
+        rows = list(pool.map(_compare_catalog_version, [str(path) for path in data_paths]))
+    return pd.DataFrame(rows).set_index('version')
+
+def loadable_catalog_versions(devices: list = CATALOG_DEVICES) -> list:
+    ''' Returns the data/energy_storage_devices*.csv files that have the columns and formulas of devices, see
+        check_device_data; the older versions miss columns or formulas '''
+    paths = []
+    for path in sorted(DATA_PATH.glob('energy_storage_devices*.csv')):
+        try:
+            check_device_data(path, devices)
+        except (ValueError, KeyError):
+            continue
+        paths.append(path)
+    return paths
+
+_worker_scenario = {} # microgrid_spec, agent, horizon, load, devices and caps of the comparison, set once per worker process
+
+def _init_comparison_worker(scenario: dict, agent: object, horizon: int, load: float, devices: list, caps: list) -> None:
+    _worker_scenario.update(spec=scenario, agent=agent, horizon=horizon, load=load, devices=devices, caps=caps)
+
+def _compare_catalog_version(data_path: str) -> dict:
+    version = Path(data_path).stem
+    try: # a data error in one version is reported in its row, pool.map would stop at it
+        return {'version': version, **_run_catalog_version(data_path)}
+    except (ValueError, KeyError) as error:
+        return {'version': version, 'error': repr(error)}
+
+def _run_catalog_version(data_path: str) -> dict:
+    check_device_data(data_path, _worker_scenario['devices'])
+    ss = StorageSuite(filename=data_path, load=_worker_scenario['load'], cache=True, devices=_worker_scenario['devices'])
+    ss.resize(_worker_scenario['caps'], reset_state=True)
+    spec = dict(_worker_scenario['spec']) # the time series are shared, the records are fresh
+    for key in RECORD_KEYS:
+        spec[key] = copy.deepcopy(spec[key])
+    for device in ss.devices:
+        _, prefix = mg.Microgrid.storage_prefixes(device.name)
+        spec['df_status'][f'{prefix}_soc'] = [device.soc]
+        spec['df_status'][f'{prefix}_capa_to_charge'] = [device.capa_to_charge]
+        spec['df_status'][f'{prefix}_capa_to_discharge'] = [device.capa_to_discharge]
+    spec['storage_suite'] = ss
+    env = mg.Microgrid.Microgrid(microgrid_spec=spec)
+    result = GridOptimizer.run_episode(env=env, horizon=_worker_scenario['horizon'], agent=_worker_scenario['agent'])
+    return {**result, 'capital_cost': ss.get_total_capital_cost()}
 
 
@@ -33,6 +33,7 @@ import cufflinks as cf
 from IPython.display import display
 from IPython import get_ipython
 from pymgrid.algos.Control import Benchmarks
+from Storage import StorageBank, HOUR_SECONDS
 
 # def in_ipynb():
 #     try:
@@ -52,8 +53,88 @@ np.random.seed(123)
 #cf.set_config_file(offline=True, theme='pearl') #commented for now, issues with parallel processes
 
 DEFAULT_HORIZON = 31579200/900 #in seconds
-DEFAULT_TIMESTEP = 1 #in seconds
+DEFAULT_TIMESTEP = None #in seconds, e.g. 900 for the 15 minutes of the time series; None steps the storage per call
 ZERO = 10**-5
+# order of the observation returned by Microgrid.run and Microgrid.reset (Microgrid.obs_fields), the status fields
+# of a microgrid that are not listed here come after them, in the order of its status record
+OBS_FIELDS = ('load', 'hour', 'pv',
+              'li_ion_soc', 'li_ion_capa_to_charge', 'li_ion_capa_to_discharge',
+              'flow_soc', 'flow_capa_to_charge', 'flow_capa_to_discharge',
+              'flywheel_soc', 'flywheel_capa_to_charge', 'flywheel_capa_to_discharge',
+              'grid_variables', 'grid_co2', 'grid_price_import', 'grid_price_export')
+FORK_ROWS = 64 # rows preallocated in the records of Microgrid.fork, they grow when needed
+
+# control vector returned by Microgrid.actions_agent, load and pv are filled in by Microgrid.run. The storage devices
+# that are not li-ion, flow or flywheel add their controls after it, see Microgrid.control_layout
+CONTROL_LAYOUT = ('pv_consummed', 'li_charge', 'li_discharge', 'flow_charge', 'flow_discharge', 'flywheel_charge',
+                  'flywheel_discharge', 'grid_import', 'grid_export', 'genset', 'load', 'pv')
+CONTROL_INDEX = {key: i for i, key in enumerate(CONTROL_LAYOUT)}
+
+# discrete actions of the agent: (storage controls with the share of the net load each one takes, grid control,
+# whether the genset covers the net load when the discharged device is at its minimum soc). These are the actions of
+# li-ion, flow and flywheel, see agent_actions for other storage devices
+AGENT_ACTIONS = (
+    ((('li_charge', 1),), 'grid_export', False),                                                     # CHARGE LI-ION
+    ((('li_discharge', 1),), 'grid_export', True),                                                   # DISCHARGE LI-ION
+    ((('flow_charge', 1),), 'grid_export', False),                                                   # CHARGE FLOW
+    ((('flow_discharge', 1),), 'grid_export', True),                                                 # DISCHARGE FLOW
+    ((('flywheel_charge', 1),), 'grid_export', False),                                               # CHARGE FLYWHEEL
+    ((('flywheel_discharge', 1),), 'grid_export', True),                                             # DISCHARGE FLYWHEEL
+    ((), 'grid_import', False),                                                                      # IMPORT
+    ((), 'grid_export', False),                                                                      # EXPORT
+    ((('li_charge', 3), ('flow_charge', 3), ('flywheel_charge', 3)), 'grid_import', False),          # COMBINED CHARGE IMPORT
+    ((('li_discharge', 3), ('flow_discharge', 3), ('flywheel_discharge', 3)), 'grid_export', False), # COMBINED DISCHARGE EXPORT
+)
+
+_PV_CONSUMMED, _GENSET, _LOAD, _PV = (CONTROL_INDEX[key] for key in ('pv_consummed', 'genset', 'load', 'pv'))
+_GRID_IMPORT, _GRID_EXPORT = CONTROL_INDEX['grid_import'], CONTROL_INDEX['grid_export']
+
+# storage device name -> (prefix of its controls, prefix of its records), for the devices of CONTROL_LAYOUT
+_STORAGE_PREFIXES = {'li-ion': ('li', 'li_ion'), 'flow': ('flow', 'flow'), 'flywheel': ('flywheel', 'flywheel')}
+
+def storage_prefixes(name) -> tuple:
+    """ Returns the prefix of the controls (<prefix>_charge, <prefix>_discharge) and the prefix of the records
+    (<prefix>_soc, <prefix>_charge, ...) of a storage device of a StorageSuite, its name with - as _ by default. """
+    if name in _STORAGE_PREFIXES:
+        return _STORAGE_PREFIXES[name]
+    prefix = name.replace('-', '_')
+    return prefix, prefix
+
+def agent_actions(controls) -> tuple:
+    """ Returns the discrete actions of the agent, in the format of AGENT_ACTIONS, for the (charge, discharge) storage
+    controls of each device: charge then discharge each device, import, export, then charge and discharge all the
+    devices at once, each one taking an equal share of the net load. """
+    actions = []
+    for charge, discharge in controls:
+        actions.append((((charge, 1),), 'grid_export', False))
+        actions.append((((discharge, 1),), 'grid_export', True))
+    actions.append(((), 'grid_import', False))
+    actions.append(((), 'grid_export', False))
+    actions.append((tuple((charge, len(controls)) for charge, _ in controls), 'grid_import', False))
+    actions.append((tuple((discharge, len(controls)) for _, discharge in controls), 'grid_export', False))
+    return tuple(actions)
+
+def _action_table(actions, control_index, storage_controls) -> tuple:
+    """ Returns the actions with the slots of their controls: ((slot, device, charging, share) of each storage control,
+    slot of the grid control, genset_if_empty), device being the registry index given by storage_controls. """
+    return tuple((tuple((control_index[key],) + storage_controls[key] + (float(share),) for key, share in storage),
+                  control_index[grid], genset_if_empty) for storage, grid, genset_if_empty in actions)
+
+def _vector_tables(action_table, n_devices) -> tuple:
+    """ Returns an action table as arrays for VecMicrogrid: share of the net load of each storage control per action (1
+    if unused), whether each storage control is used, grid control and devices that call the genset when empty. The
+    storage controls are the charge of the devices in registry order, then their discharge. """
+    share = np.ones((len(action_table), 2 * n_devices))
+    used = np.zeros(share.shape, dtype=bool)
+    genset_device = np.zeros((len(action_table), n_devices), dtype=bool)
+    for action, (storage, _, genset_if_empty) in enumerate(action_table):
+        for slot, device, charge, part in storage:
+            column = device if charge else n_devices + device
+            share[action, column] = part
+            used[action, column] = True
+            genset_device[action, device] = genset_if_empty
+    grid_slot = np.array([grid for _, grid, _ in action_table])
+    return share, used, grid_slot, genset_device
 
 '''
 The following classes are used to contain the information related to the different components
@@ -156,6 +237,156 @@ class Grid:
         self.co2 = co2
 
 
+class RecordRow:
+    """
+    Read-only view on one row of a ColumnarRecorder, indexed by column name like the dictionaries the recording
+    functions used to receive. The values are not copied, the row is a view of the recorder array.
+    """
+    __slots__ = ('_index', 'values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return zip(self._index, self.values)
+
+
+class ColumnarRecorder:
+    """
+    The class ColumnarRecorder keeps the history of one of the microgrid records (actions, status, production, cost,
+    co2) in a preallocated float64 array with one column per key, written row by row by index.
+
+    Parameters
+    ----------
+    columns : dict or list
+        Keys of the record. When a dict of lists is given (the format of the microgrid_spec), its values are used as
+        the first rows.
+    rows: int
+        Number of rows to preallocate, typically the horizon of the episode. The buffer doubles when it is full.
+
+    Attributes
+    ----------
+    rows: int
+        Number of rows recorded so far.
+
+    Notes
+    -----
+    rec[key] returns a view of the recorded part of the column, so rec[key][-1] is the last value and rec[key][0]
+    the first one as with the lists. last_row() returns a RecordRow view of the last row without building a dict.
+    Keys that are not written in a row hold 0, or the previous value when the row is opened with carry=True. None is
+    recorded as nan. A recorder returned by fork(initial=n) holds the first n rows of the episode apart from its rows,
+    the next truncate puts them back.
+
+    Examples
+    --------
+    >>> rec = ColumnarRecorder(['co2'], rows=4)
+    >>> rec.new_row()
+    >>> rec.put('co2', 1.5)
+    >>> rec['co2'][-1]
+    1.5
+    """
+    def __init__(self, columns, rows=0):
+        self._index = {key: j for j, key in enumerate(columns)}
+        first = [columns[key] for key in self._index] if isinstance(columns, dict) else []
+        start = min(len(col) for col in first) if first else 0
+        self._data = np.zeros((max(int(rows), start, 1), len(self._index)), dtype=np.float64)
+        for j, col in enumerate(first):
+            self._data[:start, j] = [0 if isinstance(v, dict) else v for v in col[:start]]
+        self.rows = start
+        self._initial = None # first rows of the episode when they are not the first rows of _data, see fork
+
+    def new_row(self, carry=False):
+        """ Opens the next row, filled with zeros or with a copy of the previous row if carry is True. """
+        if self.rows == self._data.shape[0]:
+            self._data = np.concatenate((self._data, np.zeros_like(self._data)))
+        if carry and self.rows:
+            self._data[self.rows] = self._data[self.rows - 1]
+        else:
+            self._data[self.rows] = 0
+        self.rows += 1
+
+    def put(self, key, value):
+        """ Writes value in the last row. """
+        self._data[self.rows - 1, self._index[key]] = value
+
+    def put_columns(self, columns, values):
+        """ Writes values in the last row, at the column indices returned by columns. """
+        self._data[self.rows - 1, columns] = values
+
+    def last_row(self):
+        """ Returns a RecordRow view of the last row. """
+        return RecordRow(self._index, self._data[self.rows - 1])
+
+    def truncate(self, rows=0):
+        """ Drops every row after the first ones, the buffer is kept for the next episode. """
+        if self._initial is not None: # a fork, its first rows are not the first rows of the episode
+            rows = min(rows, len(self._initial))
+            self._data[:rows] = self._initial[:rows]
+            self._initial = None
+            self.rows = rows
+            return
+        self.rows = min(rows, self.rows)
+
+    def to_dict(self) -> dict:
+        """ Returns the record as a dict of lists, the format of the microgrid_spec. """
+        return {key: self._data[:self.rows, j].tolist() for key, j in self._index.items()}
+
+    def __getitem__(self, key):
+        return self._data[:self.rows, self._index[key]]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self._index)
+
+    def columns(self, keys) -> np.ndarray:
+        """ Returns the column index of each key. """
+        return np.array([self._index[key] for key in keys], dtype=np.intp)
+
+    def fork(self, keep=0, rows=FORK_ROWS, initial=0):
+        """
+        Returns a new recorder with the same keys holding the last keep rows, with room for rows more. The first
+        initial rows of the episode are kept apart, for truncate.
+        """
+        other = ColumnarRecorder.__new__(ColumnarRecorder)
+        other._index = self._index
+        keep = min(keep, self.rows)
+        first = self._data[:self.rows] if self._initial is None else self._initial
+        other._initial = first[:initial].copy() if initial else None
+        other._data = np.zeros((max(keep + rows, initial, 1), len(self._index)), dtype=np.float64)
+        other._data[:keep] = self._data[self.rows - keep:self.rows]
+        other.rows = keep
+        return other
+
+    def __deepcopy__(self, memo):
+        other = ColumnarRecorder.__new__(ColumnarRecorder)
+        other._index = self._index
+        other._data = self._data.copy()
+        other.rows = self.rows
+        other._initial = None if self._initial is None else self._initial.copy()
+        return other
+
+
 class Microgrid:
 
     def __init__(self, microgrid_spec, horizon=DEFAULT_HORIZON, timestep=DEFAULT_TIMESTEP):
@@ -182,29 +413,47 @@ class Microgrid:
             self._next_grid_price_export = self._grid_price_export.iloc[0, 0]
             self._next_grid_price_import = self._grid_price_import.iloc[0, 0]
             self._next_grid_co2 = self._grid_co2.iloc[0, 0]
-        # those dataframe record what is happening at each time step
-        # self.current_status = parameters['df_status'] # Used to create record of previous timestep
-        self._df_record_control_dict=microgrid_spec['df_actions']
-        self._df_record_state = microgrid_spec['df_status']
-        self._df_record_actual_production = microgrid_spec['df_actual_generation']
-        self._df_record_cost = microgrid_spec['df_cost']
-        self._df_record_co2 = microgrid_spec['df_co2']
+        # the same time series as float64 arrays, indexed by update_variables at every step (the DataFrames stay available)
+        # data set -> (load, pv, grid status, grid price import, grid price export, grid co2), the grid ones None without grid
+        self._series = {'all': self._series_arrays(self._load_ts, self._pv_ts, *self._grid_series())}
         self._df_cost_per_epochs = []
+        self.total_cost = 0.0 # cost and co2 of the episode so far
+        self.total_co2 = 0.0
         self.horizon = horizon
         self._tracking_timestep = 0
         self._data_length = min(self._load_ts.shape[0], self._pv_ts.shape[0])
+        self._data_lengths = {'all': self._data_length} # data set -> data length, used by reset
+        # those records keep what is happening at each time step, preallocated for one episode
+        # self.current_status = parameters['df_status'] # Used to create record of previous timestep
+        rows = int(min(self.horizon, self._data_length)) + 1
+        self._df_record_control_dict = ColumnarRecorder(microgrid_spec['df_actions'], rows)
+        self._df_record_state = ColumnarRecorder(microgrid_spec['df_status'], rows)
+        self._df_record_actual_production = ColumnarRecorder(microgrid_spec['df_actual_generation'], rows)
+        self._df_record_cost = ColumnarRecorder(microgrid_spec['df_cost'], rows)
+        self._df_record_co2 = ColumnarRecorder(microgrid_spec['df_co2'], rows)
+        # the observation is the last status row, in the order of obs_fields, written into a float32 buffer
+        state_keys = tuple(self._df_record_state.keys())
+        self.obs_fields = tuple(key for key in OBS_FIELDS if key in state_keys) + \
+                          tuple(key for key in state_keys if key not in OBS_FIELDS)
+        self._obs_columns = self._df_record_state.columns(self.obs_fields)
+        self._obs = np.zeros(len(self.obs_fields), dtype=np.float32)
         self.done = False
         self._has_run_rule_based_baseline = False
         self._has_run_mpc_baseline = False
         self._has_train_test_split = False
         self._epoch=0
         self._zero = ZERO
+        # with a timestep, storage commands are powers held for the step in W; without one (the default), each command
+        # is the energy of one Storage._charge or Storage._discharge call, in Wh
+        self.timestep = timestep
+        self._step_hours = 1 if timestep is None else timestep / HOUR_SECONDS # energy over a step in Wh per W of mean power
         self.control_dict = microgrid_spec['control_dict']
         self._data_set_to_use_default = 'all'
         self._data_set_to_use = 'all'
         self.benchmarks = Benchmarks(self)
         self.ss = microgrid_spec['storage_suite'] # Load Storage class objects
-        self.li_ion, self.flow_battery, self.flywheel = self.ss.unpack() # These are all objects
+        self._initial_storage = self.ss.save_state() # state of the devices put back by reset
+        self._layout_storage()
         if self.architecture['genset'] == 1:
             self.genset = Genset(self.parameters)
         if self.architecture['grid'] == 1:
@@ -213,207 +462,101 @@ class Microgrid:
                              self._grid_price_export.iloc[0, 0],
                              self._grid_co2.iloc[0, 0])
 
-    def actions_agent(self, action) -> dict:
-        '''Accepts action selection as an integer, Returns control dictionary'''
-        pv =                            self.pv
-        load =                          self.load
-        net_load =                      load-pv
-        status =                        self.grid.status
-
-        li_ion_charge =                 max(0,min(-net_load,self.li_ion.capa_to_charge ,self.li_ion.power))
-        li_ion_discharge =              max(0,min(net_load,self.li_ion.capa_to_discharge,self.li_ion.power))
+    def _grid_series(self) -> tuple:
+        if self.architecture['grid'] == 1:
+            return self._grid_status_ts, self._grid_price_import, self._grid_price_export, self._grid_co2
+        return None, None, None, None
 
-        flow_charge =                   max(0,min(-net_load,self.flow_battery.capa_to_charge ,self.flow_battery.power))
-        flow_discharge =                max(0,min(net_load,self.flow_battery.capa_to_discharge,self.flow_battery.power))
+    @staticmethod
+    def _series_arrays(*series) -> tuple:
+        """ Returns the first column of each DataFrame as a contiguous float64 array (None stays None). """
+        return tuple(None if df is None else np.ascontiguousarray(df.iloc[:, 0].to_numpy(dtype=np.float64)) for df in series)
 
-        flywheel_charge=                max(0,min(-net_load,self.flywheel.capa_to_charge ,self.flywheel.power))
-        flywheel_discharge =            max(0,min(net_load,self.flywheel.capa_to_discharge,self.flywheel.power))
-        
-        li_ion_soc =                    abs(self.li_ion.soc)
-        flow_soc =                      abs(self.flow_battery.soc)
-        flywheel_soc =                  abs(self.flywheel.soc)
+    def _layout_storage(self):
+        """
+        Lays out the controls, the agent actions and the record columns of the storage devices of self.ss. The devices
+        that are not in CONTROL_LAYOUT add their controls after it, in registry order, and the agent actions are built
+        by agent_actions from the devices in the order of their controls (AGENT_ACTIONS for li-ion, flow and flywheel).
+        """
+        prefixes = [storage_prefixes(device.name) for device in self.ss.devices]
+        controls = [(control + '_charge', control + '_discharge') for control, _ in prefixes]
+        self.control_layout = CONTROL_LAYOUT + tuple(key for pair in controls if pair[0] not in CONTROL_INDEX for key in pair)
+        self._control_index = {key: i for i, key in enumerate(self.control_layout)}
+        self._control = np.zeros(len(self.control_layout)) # buffer of actions_agent
+        # storage controls of the devices in registry order
+        self._charge_keys, self._discharge_keys = (tuple(keys) for keys in zip(*controls)) if controls else ((), ())
+        self._charge_slots = np.array([self._control_index[key] for key in self._charge_keys], dtype=np.intp)
+        self._discharge_slots = np.array([self._control_index[key] for key in self._discharge_keys], dtype=np.intp)
+        storage_controls = {}
+        for j, (charge, discharge) in enumerate(controls):
+            storage_controls[charge], storage_controls[discharge] = (j, True), (j, False)
+        self.agent_actions = agent_actions(sorted(controls, key=lambda pair: self._control_index[pair[0]]))
+        self._action_table = _action_table(self.agent_actions, self._control_index, storage_controls)
+        # record columns of the storage fields that the records have: (positions in the values of the devices, columns)
+        self._production_columns = self._record_columns(self._df_record_actual_production, prefixes, ('charge', 'discharge'))
+        self._status_columns = self._record_columns(self._df_record_state, prefixes,
+                                                    ('soc', 'capa_to_charge', 'capa_to_discharge'))
+
+    @staticmethod
+    def _record_columns(record, prefixes, fields) -> tuple:
+        """ Returns the positions of the <record prefix>_<field> columns of record in the values of every field of the
+        devices laid end to end, and the record columns they are written to. """
+        positions, keys = [], []
+        for k, field in enumerate(fields):
+            for j, (_, prefix) in enumerate(prefixes):
+                if prefix + '_' + field in record:
+                    positions.append(k * len(prefixes) + j)
+                    keys.append(prefix + '_' + field)
+        return np.array(positions, dtype=np.intp), record.columns(keys)
+
+    def actions_agent(self, action) -> np.ndarray:
+        """
+        Accepts action selection as an integer, Returns the control vector laid out as self.control_layout.
 
-        capa_to_genset = self.genset.rated_power * self.genset.p_max
-        p_genset = max(0, min(net_load, capa_to_genset))
-        
-        if action == 0:
-            # CHARGE LI-ION
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': min(net_load,li_ion_charge),
-                                'li_discharge': 0,
-                                'flow_charge': 0,
-                                'flow_discharge': 0,
-                                'flywheel_charge': 0,
-                                'flywheel_discharge': 0,
-                                'grid_import': 0,
-                                'grid_export': abs(net_load)*status,
-                                'genset': 0
-                            }
-        if action == 1:
-            # DISCHARGE LI-ION
-            if li_ion_soc == self.li_ion.MIN_SOC:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': min(net_load,li_ion_discharge),
-                                    'flow_charge': 0,
-                                    'flow_discharge': 0,
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': 0,
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': p_genset
-                                }
-            else:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': min(net_load,li_ion_discharge),
-                                    'flow_charge': 0,
-                                    'flow_discharge': 0,
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': 0,
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': 0
-                                }
-    ######################
-        if action == 2:
-            # CHARGE FLOW
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': 0,
-                                'li_discharge': 0,
-                                'flow_charge': min(net_load,flow_charge),
-                                'flow_discharge': 0,
-                                'flywheel_charge': 0,
-                                'flywheel_discharge': 0,
-                                'grid_import': 0,
-                                'grid_export': abs(net_load)*status,
-                                'genset': 0
-                            }
-        if action == 3:
-            # DISCHARGE FLOW
-            if flow_soc == self.flow_battery.MIN_SOC:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': 0,
-                                    'flow_charge': 0,
-                                    'flow_discharge': min(net_load,flow_discharge),
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': 0,
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': p_genset
-                                }
-            else:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': 0,
-                                    'flow_charge': 0,
-                                    'flow_discharge': min(net_load,flow_discharge),
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': 0,
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': 0
-                                }
-    ######################
-        if action == 4:
-            # CHARGE FLYWHEEL
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': 0,
-                                'li_discharge': 0,
-                                'flow_charge': 0,
-                                'flow_discharge': 0,
-                                'flywheel_charge': min(net_load,flywheel_charge),
-                                'flywheel_discharge': 0,
-                                'grid_import': 0,
-                                'grid_export': abs(net_load)*status,
-                                'genset': 0
-                            }
-        if action == 5:
-            # DISCHARGE FLYWHEEL
-            if flywheel_soc == self.flywheel.MIN_SOC:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': 0,
-                                    'flow_charge': 0,
-                                    'flow_discharge': 0,
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': min(net_load,flywheel_discharge),
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': p_genset
-                                }
+        The action is decoded with self.agent_actions into a buffer that is reused at every call, copy it to keep it.
+        dict(zip(self.control_layout, control)) gives the control dictionary.
+        """
+        pv =                            self.pv
+        load =                          self.load
+        net_load =                      load-pv
+        storage, grid_slot, genset_if_empty = self._action_table[action]
+
+        control = self._control
+        control.fill(0)
+        control[_PV_CONSUMMED] = min(pv,load)
+        control[grid_slot] = abs(net_load)*self.grid.status
+
+        devices = self.ss.devices
+        for slot, j, charge, share in storage:
+            device = devices[j]
+            if charge: # the capacities are energies, the power that fills or empties them in one step
+                headroom = max(0,min(-net_load,device.capa_to_charge/self._step_hours ,device.power))
             else:
-                control_dict = {    'pv_consummed': min(pv,load),
-                                    'li_charge': 0,
-                                    'li_discharge': 0,
-                                    'flow_charge': 0,
-                                    'flow_discharge': 0,
-                                    'flywheel_charge': 0,
-                                    'flywheel_discharge': min(net_load,flywheel_discharge),
-                                    'grid_import': 0,
-                                    'grid_export': abs(net_load)*status,
-                                    'genset': 0
-                                }
-    ######################
-        if action == 6:
-            # IMPORT
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': 0,
-                                'li_discharge': 0,
-                                'flow_charge': 0,
-                                'flow_discharge': 0,
-                                'flywheel_charge': 0,
-                                'flywheel_discharge': 0,
-                                'grid_import': abs(net_load)*status,
-                                'grid_export': 0,
-                                'genset': 0
-                            }
-                            
-        if action == 7:
-            # EXPORT
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': 0,
-                                'li_discharge': 0,
-                                'flow_charge': 0,
-                                'flow_discharge': 0,
-                                'flywheel_charge': 0,
-                                'flywheel_discharge': 0,
-                                'grid_import': 0,
-                                'grid_export': abs(net_load)*status,
-                                'genset': 0
-                            }
-
-    ######################
-        if action == 8:
-            # COMBINED CHARGE IMPORT
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': min(net_load/3,li_ion_charge),
-                                'li_discharge': 0,
-                                'flow_charge': min(net_load/3,flow_charge),
-                                'flow_discharge': 0,
-                                'flywheel_charge': min(net_load/3,flywheel_charge),
-                                'flywheel_discharge': 0,
-                                'grid_import': abs(net_load)*status,
-                                'grid_export': 0,
-                                'genset': 0
-                            }
-                            
-        if action == 9:
-            # COMBINED DISCHARGE EXPORT
-            control_dict = {    'pv_consummed': min(pv,load),
-                                'li_charge': 0,
-                                'li_discharge': min(net_load/3,li_ion_discharge),
-                                'flow_charge': 0,
-                                'flow_discharge': min(net_load/3.,flow_discharge),
-                                'flywheel_charge': 0,
-                                'flywheel_discharge': min(net_load/3,flywheel_discharge),
-                                'grid_import': 0,
-                                'grid_export': abs(net_load)*status,
-                                'genset': 0
-                            }
-            
-        return control_dict
+                headroom = max(0,min(net_load,device.capa_to_discharge/self._step_hours,device.power))
+            control[slot] = min(net_load/share,headroom)
+            if device.sensitivity is not None:
+                self._command_sensitivity(device, charge, control[slot], headroom)
+            if genset_if_empty and abs(device.soc) == device.MIN_SOC:
+                control[_GENSET] = max(0, min(net_load, self.genset.rated_power * self.genset.p_max))
+
+        return control
+
+    def _command_sensitivity(self, device, charge, command, headroom):
+        """Gives the sensitivity tracker of device the derivative of its command when the power or the capacity of
+        the device limited it in actions_agent, so that score gradients follow the command."""
+        sensitivity = device.sensitivity
+        step_hours = self._step_hours
+        if command <= 0 or command < headroom: # no command, or the share of the net load
+            dcommand = 0
+        elif headroom == device.power:
+            dcommand = sensitivity.dpower(device)
+        elif charge and headroom == device.capa_to_charge/step_hours:
+            dcommand = sensitivity.dcapa_to_charge(device)/step_hours
+        elif not charge and headroom == device.capa_to_discharge/step_hours:
+            dcommand = sensitivity.dcapa_to_discharge(device)/step_hours
+        else: # the net load
+            dcommand = 0
+        sensitivity.command(command, dcommand)
 
     def _param_check(self, parameters):
         """Simple parameter checks"""
@@ -510,12 +653,18 @@ class Microgrid:
             - Whether the grid is connected or not
             - CO2 intensity of the grid
         """
-        mg_data = {}
+        row = self._df_record_state.last_row()
 
-        for i in self._df_record_state:
-            mg_data[i] = self._df_record_state[i][-1]
+        return dict(zip(row.keys(), row.values.tolist()))
 
-        return mg_data
+    def get_observation(self, copy=True) -> np.ndarray:
+        """
+        Function that returns the values of get_updated_values as a float32 array, in the order of obs_fields (see
+        OBS_FIELDS). With copy=False the observation buffer itself is returned, without any allocation: it is
+        overwritten by the next call, so it can be wrapped once with torch.from_numpy but not kept as a past state.
+        """
+        self._obs[:] = self._df_record_state.last_row().values[self._obs_columns]
+        return self._obs.copy() if copy else self._obs
 
 
     def forecast_all(self):
@@ -623,45 +772,80 @@ class Microgrid:
 
 
     #if return whole pv and load ts, the time can be counted in notebook
-    def run(self, control_dict):
+    def run(self, control_dict, copy=True):
+        """
+        Runs one time step with control_dict, either a control dictionary or a vector laid out as self.control_layout.
+        Returns the observation (see get_observation, copy is passed to it), the cost of the step / 4000 and done.
+        """
 
-        control_dict['load'] = self.load
-        control_dict['pv'] = self.pv
+        if isinstance(control_dict, np.ndarray):
+            control_dict[_LOAD] = self.load
+            control_dict[_PV] = self.pv
+            control_dict = RecordRow(self._control_index, control_dict)
+        else:
+            control_dict['load'] = self.load
+            control_dict['pv'] = self.pv
 
         self._df_record_control_dict = self._record_action(control_dict = control_dict, record_status = self._df_record_control_dict)
 
         self._df_record_actual_production = self._record_production(control_dict, self._df_record_actual_production,self._df_record_state)
 
+        production = self._df_record_actual_production.last_row()
+
         if self.architecture['grid'] == 1:
-            self._df_record_co2 = self._record_co2({i:self._df_record_actual_production[i][-1] for i in self._df_record_actual_production},
-                                                   self._df_record_co2, self.grid.co2)
+            self._df_record_co2 = self._record_co2(production, self._df_record_co2, self.grid.co2)
 
-            self._df_record_cost = self._record_cost({ i:self._df_record_actual_production[i][-1] for i in self._df_record_actual_production},
-                                                               self._df_record_cost, self._df_record_co2, self.grid.price_import, self.grid.price_export)
+            self._df_record_cost = self._record_cost(production, self._df_record_cost, self._df_record_co2,
+                                                     self.grid.price_import, self.grid.price_export)
 
-            self._df_record_state = self._update_status(production_dict={key: value[-1] for key, value in self._df_record_actual_production.items()},
+            self._df_record_state = self._update_status(production_dict=production,
                                                         record_state = self._df_record_state,next_load= self._next_load,next_pv= self._next_pv,
                                                         next_grid = self._next_grid_status, next_price_import= self._next_grid_price_import,
                                                         next_price_export= self._next_grid_price_export, next_co2= self._next_grid_co2)
 
 
         else:
-            self._df_record_co2 = self._record_co2({ i:self._df_record_actual_production[i][-1] for i in self._df_record_actual_production},
-                                                   self._df_record_co2)
+            self._df_record_co2 = self._record_co2(production, self._df_record_co2)
 
-            self._df_record_cost = self._record_cost({ i:self._df_record_actual_production[i][-1] for i in self._df_record_actual_production},
-                                                     self._df_record_cost, self._df_record_co2)
+            self._df_record_cost = self._record_cost(production, self._df_record_cost, self._df_record_co2)
             self._df_record_state = self._update_status(control_dict,
                                                         self._df_record_state, self._next_load, self._next_pv)
 
+        self.total_cost += self.get_cost()
+        self.total_co2 += self.get_co2()
+
         if self._tracking_timestep == self.horizon or self._tracking_timestep == self._data_length - 1:  
             self.done = True
-            return list(self.get_updated_values().values()), self.get_cost()/4_000, self.done
+            return self.get_observation(copy), self.get_cost()/4_000, self.done
 
         self._tracking_timestep += 1
         self.update_variables()
 
-        return list(self.get_updated_values().values()), self.get_cost()/4_000, self.done
+        return self.get_observation(copy), self.get_cost()/4_000, self.done
+
+    def fork(self):
+        """
+        Returns a copy of the microgrid at the current time step, to try actions without changing this one (lookahead
+        search, rollouts). The time series, parameters and benchmarks are shared. The storage devices, the grid values,
+        the time step and the running total_cost and total_co2 are copied. The records of the fork only start with the
+        last row of the records of this microgrid, the initial status row is kept for reset.
+        """
+        other = Microgrid.__new__(Microgrid)
+        other.__dict__.update(self.__dict__)
+        other.ss = self.ss.fork()
+        if self.architecture['grid'] == 1:
+            other.grid = copy(self.grid)
+        other._series = dict(self._series)
+        other._data_lengths = dict(self._data_lengths)
+        other._control = self._control.copy()
+        other._obs = self._obs.copy()
+        other._df_cost_per_epochs = []
+        other._df_record_control_dict = self._df_record_control_dict.fork(keep=1)
+        other._df_record_state = self._df_record_state.fork(keep=1, initial=1)
+        other._df_record_actual_production = self._df_record_actual_production.fork(keep=1)
+        other._df_record_cost = self._df_record_cost.fork(keep=1)
+        other._df_record_co2 = self._df_record_co2.fork(keep=1)
+        return other
 
     def train_test_split(self, train_size=0.67, shuffle = False, cancel=False):
         """
@@ -725,6 +909,12 @@ class Microgrid:
                 self._grid_co2_train = self._grid_co2.iloc[:self._limit_index]
                 self._grid_co2_test = self._grid_co2.iloc[self._limit_index:]
 
+            # views of the full arrays, nothing is copied
+            self._series['training'] = tuple(None if a is None else a[:self._limit_index] for a in self._series['all'])
+            self._series['testing'] = tuple(None if a is None else a[self._limit_index:] for a in self._series['all'])
+            self._data_lengths['training'] = min(self._load_train.shape[0], self._pv_train.shape[0])
+            self._data_lengths['testing'] = min(self._load_test.shape[0], self._pv_test.shape[0])
+
             self._has_train_test_split = True
             self._data_set_to_use_default = 'training'
             self._data_set_to_use = 'training'
@@ -738,105 +928,66 @@ class Microgrid:
 
     def update_variables(self):
         """ Function that updates the variablers containing the parameters of the microgrid changing with time. """
-        if self._data_set_to_use == 'training':
-            self.pv = self._pv_train.iloc[self._tracking_timestep, 0]
-            self.load = self._load_train.iloc[self._tracking_timestep, 0]
-
-            self._next_pv = self._pv_train.iloc[self._tracking_timestep +1, 0]
-            self._next_load = self._load_train.iloc[self._tracking_timestep+1, 0]
-
-
-        if self._data_set_to_use == 'testing':
-            self.pv = self._pv_test.iloc[self._tracking_timestep, 0]
-            self.load = self._load_test.iloc[self._tracking_timestep, 0]
-
-            self._next_pv = self._pv_test.iloc[self._tracking_timestep+1, 0]
-            self._next_load = self._load_test.iloc[self._tracking_timestep+1, 0]
-
-        if self._data_set_to_use == 'all':
-            self.pv = self._pv_ts.iloc[self._tracking_timestep, 0]
-            self.load = self._load_ts.iloc[self._tracking_timestep, 0]
-
+        load, pv, grid_status, price_import, price_export, co2 = self._series[self._data_set_to_use]
+        t = self._tracking_timestep
+        has_next = t < self._data_length - 1
+        self.pv = pv[t]
+        self.load = load[t]
+        if has_next:
+            self._next_pv = pv[t+1]
+            self._next_load = load[t+1]
+        else:
+            self._next_pv, self._next_load = None, None
 
-            if self._tracking_timestep < self._data_length - 1:
-                self._next_pv = self._pv_ts.iloc[self._tracking_timestep+1, 0]
-                self._next_load = self._load_ts.iloc[self._tracking_timestep+1, 0]
+        if self.architecture['grid']==1:
+            self.grid.status = grid_status[t]
+            self.grid.price_import = price_import[t]
+            self.grid.price_export = price_export[t]
+            self.grid.co2 = co2[t]
+
+            if has_next:
+                self._next_grid_status = grid_status[t+1]
+                self._next_grid_price_import = price_import[t+1]
+                self._next_grid_price_export = price_export[t+1]
+                self._next_grid_co2 = co2[t+1]
             else:
-                self._next_pv, self._next_load = None, None
+                self._next_grid_status, self._next_grid_price_import, self._next_grid_price_export, \
+                self._next_grid_co2 = None, None, None, None
 
 
-        if self.architecture['grid']==1:
-            if self._data_set_to_use == 'training':
-                self.grid.status = self._grid_status_train.iloc[self._tracking_timestep, 0]
-                self.grid.price_import = self._grid_price_import_train.iloc[self._tracking_timestep,0]
-                self.grid.price_export = self._grid_price_export_train.iloc[self._tracking_timestep,0]
-                self.grid.co2 = self._grid_co2_train.iloc[self._tracking_timestep, 0]
-
-                self._next_grid_status = self._grid_status_train.iloc[self._tracking_timestep +1, 0]
-                self._next_grid_price_import = self._grid_price_import_train.iloc[self._tracking_timestep +1, 0]
-                self._next_grid_price_export = self._grid_price_export_train.iloc[self._tracking_timestep +1, 0]
-                self._next_grid_co2 = self._grid_co2_train.iloc[self._tracking_timestep + 1, 0]
-
-            if self._data_set_to_use == 'testing':
-                self.grid.status = self._grid_status_test.iloc[self._tracking_timestep, 0]
-                self.grid.price_import = self._grid_price_import_test.iloc[self._tracking_timestep, 0]
-                self.grid.price_export = self._grid_price_export_test.iloc[self._tracking_timestep, 0]
-                self.grid.co2 = self._grid_co2_test.iloc[self._tracking_timestep, 0]
-
-                self._next_grid_status = self._grid_status_test.iloc[self._tracking_timestep + 1, 0]
-                self._next_grid_price_import = self._grid_price_import_test.iloc[self._tracking_timestep + 1, 0]
-                self._next_grid_price_export = self._grid_price_export_test.iloc[self._tracking_timestep + 1, 0]
-                self._next_grid_co2 = self._grid_co2_test.iloc[self._tracking_timestep + 1, 0]
-
-
-            if self._data_set_to_use == 'all':
-                self.grid.status = self._grid_status_ts.iloc[self._tracking_timestep, 0]
-                self.grid.price_import = self._grid_price_import.iloc[self._tracking_timestep, 0]
-                self.grid.price_export = self._grid_price_export.iloc[self._tracking_timestep, 0]
-                self.grid.co2 = self._grid_co2.iloc[self._tracking_timestep, 0]
-
-                if self._tracking_timestep < self._data_length - 1:
-                    self._next_grid_status = self._grid_status_ts.iloc[self._tracking_timestep + 1, 0]
-                    self._next_grid_price_import = self._grid_price_import.iloc[self._tracking_timestep + 1, 0]
-                    self._next_grid_price_export = self._grid_price_export.iloc[self._tracking_timestep + 1, 0]
-                    self._next_grid_co2 = self._grid_co2.iloc[self._tracking_timestep + 1, 0]
-                else:
-                    self._next_grid_status, self._next_grid_price_import, self._next_grid_price_export, \
-                    self._next_grid_co2 = None, None, None, None
-
-
-
-    def reset(self, testing=False) -> list:
-        """This function is used to reset the dataframes that track what is happening in simulation. Mainly used in RL."""
+
+    def reset(self, testing=False, copy=True) -> np.ndarray:
+        """
+        This function is used to reset the dataframes that track what is happening in simulation. Mainly used in RL.
+        The storage devices are put back in the state they had when the microgrid was created.
+        Returns the first observation, see get_observation.
+        """
         if self._data_set_to_use == 'training':
-            temp_cost = copy(self._df_record_cost)
+            temp_cost = {key: values.copy() for key, values in self._df_record_cost.items()}
             temp_cost['epoch'] = self._epoch
             self._df_cost_per_epochs.append(temp_cost)
 
-        self._df_record_control_dict = {i:[] for i in self._df_record_control_dict}
-        self._df_record_state = {i:[self._df_record_state[i][0]] for i in self._df_record_state}
-        self._df_record_actual_production = {i:[] for i in self._df_record_actual_production}
-        self._df_record_cost = {i:[] for i in self._df_record_cost}
-        self._df_record_co2 = {i:[] for i in self._df_record_co2}
+        # the buffers are kept, only the initial status row survives
+        self._df_record_control_dict.truncate()
+        self._df_record_state.truncate(1)
+        self._df_record_actual_production.truncate()
+        self._df_record_cost.truncate()
+        self._df_record_co2.truncate()
 
         self._tracking_timestep = 0
+        self.total_cost = 0.0
+        self.total_co2 = 0.0
 
         if testing == True and self._data_set_to_use_default == 'training':
             self._data_set_to_use = 'testing'
-            self._data_length = min(self._load_test.shape[0], self._pv_test.shape[0])
         else:
             self._data_set_to_use = self._data_set_to_use_default
-            if self._data_set_to_use == 'training':
-                self._data_length = min(self._load_train.shape[0], self._pv_train.shape[0])
-            else:
-                self._data_length = min(self._load_ts.shape[0], self._pv_ts.shape[0])
-        self.li_ion.soc == self.li_ion.MAX_SOC
-        self.flow_battery.soc == self.flow_battery.MAX_SOC
-        self.flywheel.soc == self.flywheel.MAX_SOC
+        self._data_length = self._data_lengths[self._data_set_to_use]
+        self.ss.restore_state(self._initial_storage)
         self.update_variables()
         self.done = False
         self._epoch+=1
-        return list(self.get_updated_values().values())
+        return self.get_observation(copy)
 
     ########################################################
     # FUNCTIONS TO UPDATE THE INTERNAL DICTIONARIES
@@ -845,13 +996,12 @@ class Microgrid:
 
     def _record_action(self, control_dict, record_status):
         """ This function is used to record the actions taken, before being checked for feasability. """
-        if not isinstance(record_status, dict):
-            raise TypeError('We know this should be named differently but df needs to be dict, is {}'.format(type(record_status)))
+        if not isinstance(record_status, ColumnarRecorder):
+            raise TypeError('We know this should be named differently but df needs to be ColumnarRecorder, is {}'.format(type(record_status)))
+        record_status.new_row() # actions missing from control_dict are recorded as 0
         for j in record_status:
             if j in control_dict.keys():
-                record_status[j].append(control_dict[j])
-            else:
-                record_status[j].append({j:0})
+                record_status.put(j, control_dict[j])
         #df = df.append(control_dict,ignore_index=True)
 
         return record_status
@@ -861,8 +1011,8 @@ class Microgrid:
         """ This function update the parameters of the microgrid that change with time. """
         #self.df_status = self.df_status.append(self.new_row, ignore_index=True)
 
-        if not isinstance(record_state, dict):
-            raise TypeError('We know this should be named differently but df needs to be dict, is {}'.format(type(record_state)))
+        if not isinstance(record_state, ColumnarRecorder):
+            raise TypeError('We know this should be named differently but df needs to be ColumnarRecorder, is {}'.format(type(record_state)))
 
         new_dict = {
             'load': next_load,
@@ -870,26 +1020,20 @@ class Microgrid:
             'hour':self._tracking_timestep%4,
         }
 
-        new_dict['li_ion_soc'] = self.li_ion.soc
-        new_dict['li_ion_capa_to_charge'] = self.li_ion.capa_to_charge
-        new_dict['li_ion_capa_to_discharge'] = self.li_ion.capa_to_discharge
-        new_dict['flow_soc'] = self.flow_battery.soc
-        new_dict['flow_capa_to_charge'] = self.flow_battery.capa_to_charge
-        new_dict['flow_capa_to_discharge'] = self.flow_battery.capa_to_discharge
-        new_dict['flywheel_soc'] = self.flywheel.soc
-        new_dict['flywheel_capa_to_charge'] = self.flywheel.capa_to_charge
-        new_dict['flywheel_capa_to_discharge'] = self.flywheel.capa_to_discharge
-
         if self.architecture['grid'] == 1 :
             new_dict['grid_status'] = next_grid
             new_dict['grid_price_import'] = (0.11/4_000)*production_dict['grid_import']
             new_dict['grid_price_export'] = (0.05/4_000)*production_dict['grid_export']
             new_dict['grid_co2'] = next_co2
 
-        
+        # values that are not updated keep their previous value
+        record_state.new_row(carry=True)
         for j in record_state:
             if j in new_dict.keys():
-                record_state[j].append(new_dict[j])
+                record_state.put(j, new_dict[j])
+        # soc and capacities of the storage devices
+        positions, columns = self._status_columns
+        record_state.put_columns(columns, np.concatenate(self.ss.get_storage_status())[positions])
 
         return record_state
 
@@ -928,32 +1072,6 @@ class Microgrid:
 
         return p_import, p_export
 
-    def _change_storage_charge(self, power_sent: float, power_requested: float, device: str) -> float:
-        """ This function checks that the constraints of the battery are respected."""
-
-        if power_sent < 0:
-            power_sent = 0
-            # print('wHAT')
-
-        if power_requested < 0:
-            power_requested = 0
-        
-        if power_requested > 0 and power_sent > 0: # Error Raising 
-            raise ValueError("Cannot charge and discharge in the same timestep. Check your actions for conflicts")
-
-        if power_sent > 0:
-            power_sent, power_stored = self.ss.charge(stor_type = device ,power_used = power_sent)
-            power_pulled, power_requested = (0,0)
-        if power_requested > 0:
-            power_requested, power_pulled = self.ss.discharge(stor_type = device, power_requested = power_requested)
-            power_stored, power_sent = (0,0)
-        if (power_requested, power_sent) == (0,0):
-            return 0,0,0,0
-
-        return  power_stored, power_pulled, power_sent, power_requested
-
-        
-
     def _record_production(self, control_dict, production_dict, status):
         """
         This function records the actual production occuring in the microgrid. Based on the control actions and the
@@ -963,7 +1081,8 @@ class Microgrid:
         Parameters
         ----------
         control_dict : dictionnary
-            Dictionnary representing the control actions taken by an algorithm (either benchmark or in the run function).
+            Dictionnary representing the control actions taken by an algorithm (either benchmark or in the run function),
+            or RecordRow view of the control vector of actions_agent.
         df: dataframe
             Previous version of the record_production dataframe (coming from the run loop, or benchmarks).
         status: dataframe
@@ -973,62 +1092,49 @@ class Microgrid:
         -----
         The mechanism to incure a penalty in case of over-generation is not yet in its final version.
         """
-        assert isinstance(production_dict, dict)
-        try:
-            control_dict.pop('pv_consummed')
-        except KeyError:
-            pass
+        assert isinstance(production_dict, ColumnarRecorder)
+        production_dict.new_row()
+        if isinstance(control_dict, dict):
+            control_dict.pop('pv_consummed', None)
 
 
         has_grid = self.architecture['grid'] == 1
         has_genset = self.architecture['genset'] == 1
 
-        sources = 0.0
-        sinks = control_dict['load']
-
-        li_charge, li_discharge, li_used, li_requested = self._change_storage_charge(power_sent = control_dict['li_charge'], 
-                                                                                        power_requested = control_dict['li_discharge'],
-                                                                                        device='li-ion')
-        production_dict['li_ion_charge'].append(li_charge)
-        production_dict['li_ion_discharge'].append(li_discharge)#+li_self_discharge)
-        
-        sources += li_requested
-        sinks += li_used
-
-        # flow battery
-        flow_charge, flow_discharge, flow_used, flow_requested = self._change_storage_charge(power_sent = control_dict['flow_charge'], 
-                                                                                                power_requested = control_dict['flow_discharge'], 
-                                                                                                device='flow')
-        production_dict['flow_charge'].append(flow_charge)
-        production_dict['flow_discharge'].append(flow_discharge)#+flow_self_discharge)
-        
-        sources += flow_requested # Self discharge is not accounted for in sources
-        sinks += flow_used
-
-        # flywheel energy storage
-        flywheel_charge, flywheel_discharge, flywheel_used, flywheel_requested = self._change_storage_charge(power_sent = control_dict['flywheel_charge'], 
-                                                                                                                power_requested = control_dict['flywheel_discharge'], 
-                                                                                                                device='flywheel')
-        production_dict['flywheel_charge'].append(flywheel_charge)
-        production_dict['flywheel_discharge'].append(flywheel_discharge)#+flywheel_self_discharge)
-        
-        sources += flywheel_requested 
-        sinks += flywheel_used
+        # storage devices in registry order, each one charges or discharges at its control for the whole step
+        if isinstance(control_dict, RecordRow):
+            charge, discharge = control_dict.values[self._charge_slots], control_dict.values[self._discharge_slots]
+        else:
+            charge = np.array([control_dict.get(key, 0) for key in self._charge_keys], dtype=float)
+            discharge = np.array([control_dict.get(key, 0) for key in self._discharge_keys], dtype=float)
+        charge, discharge = np.maximum(charge, 0), np.maximum(discharge, 0)
+        if ((charge > 0) & (discharge > 0)).any(): # Error Raising
+            raise ValueError("Cannot charge and discharge in the same timestep. Check your actions for conflicts")
+        if self.timestep is None:
+            grid_side, device_side = self.ss.dispatch(charge - discharge)
+        else:
+            grid_side, device_side = self.ss.dispatch_interval(charge - discharge, self.timestep)
+        step_hours = self._step_hours # energies of the step -> mean powers
+        used, delivered = np.maximum(grid_side, 0) / step_hours, np.maximum(-grid_side, 0) / step_hours
+        stored, pulled = np.maximum(device_side, 0) / step_hours, np.maximum(-device_side, 0) / step_hours
+        positions, columns = self._production_columns
+        production_dict.put_columns(columns, np.concatenate((stored, pulled))[positions])
 
-        
+        sources = float(delivered.sum()) # Self discharge is not accounted for in sources
+        sinks = control_dict['load'] + float(used.sum())
 
         if has_grid:
             p_import, p_export = self._check_constraints_grid(control_dict['grid_import'],
                                                                     control_dict['grid_export'])
-            production_dict['grid_import'].append(p_import)
-            production_dict['grid_export'].append(p_export)
+            production_dict.put('grid_import', p_import)
+            production_dict.put('grid_export', p_export)
 
             sources += p_import
             sinks += p_export
 
         if has_genset:
             p_genset = self._check_constraints_genset(control_dict['genset'])
-            production_dict['genset'].append(p_genset)
+            production_dict.put('genset', p_genset)
             sources += p_genset
 
         pv_required = sinks-sources
@@ -1059,10 +1165,10 @@ class Microgrid:
             pv_curtailed = pv_available if pv_available > 0 else 0
             overgeneration = -pv_required
 
-        production_dict['pv_consummed'].append(pv_consumed)
-        production_dict['loss_load'].append(loss_load)
-        production_dict['pv_curtailed'].append(pv_curtailed)
-        production_dict['overgeneration'].append(overgeneration/4_000)
+        production_dict.put('pv_consummed', pv_consumed)
+        production_dict.put('loss_load', loss_load)
+        production_dict.put('pv_curtailed', pv_curtailed)
+        production_dict.put('overgeneration', overgeneration/4_000)
         
 
         return production_dict
@@ -1079,44 +1185,46 @@ class Microgrid:
 
         cost_dict = {'co2': co2}
 
-        df['co2'].append( co2)
+        df.new_row()
+        df.put('co2', co2)
 
         return df
 
     def _record_cost(self, control_dict, cost_dict, df_co2, cost_import=0, cost_export=0):
         """ This function record the cost of operating the microgrid at each time step."""
 
-        if not isinstance(cost_dict, dict):
-            raise TypeError('We know this should be named differently but cost_dict needs to be dict, is {}'.format(type(cost_dict)))
+        if not isinstance(cost_dict, ColumnarRecorder):
+            raise TypeError('We know this should be named differently but cost_dict needs to be ColumnarRecorder, is {}'.format(type(cost_dict)))
+        cost_dict.new_row()
 
         cost_loss_load = control_dict['loss_load'] * self.parameters['cost_loss_load'].values[0]
         cost_overgeneration = control_dict['overgeneration'] * self.parameters['cost_overgeneration'].values[0]
 
-        cost_dict['loss_load'].append(cost_loss_load)
-        cost_dict['overgeneration'].append(cost_overgeneration)
+        cost_dict.put('loss_load', cost_loss_load)
+        cost_dict.put('overgeneration', cost_overgeneration)
 
         # cost += control_dict['loss_load'] * self.parameters['cost_loss_load'].values[0]
         # cost += control_dict['overgeneration'] * self.parameters['cost_overgeneration'].values[0]
 
         if self.architecture['genset'] == 1:
             genset_cost = control_dict['genset'] * self.parameters['fuel_cost'].values[0]
-            cost_dict['genset'].append(genset_cost)
+            cost_dict.put('genset', genset_cost)
 
         if self.architecture['grid'] ==1:
             grid_import_cost = cost_import * control_dict['grid_import']
             grid_export_cost = - cost_export * control_dict['grid_export']
-            cost_dict['grid_import'].append(grid_import_cost)
-            cost_dict['grid_export'].append(grid_export_cost)
+            cost_dict.put('grid_import', grid_import_cost)
+            cost_dict.put('grid_export', grid_export_cost)
 
         
         # li_cost = (control_dict['li_charge']+control_dict['li_discharge'])*self.parameters['battery_cost_cycle'].values[0]
         # cost_dict['battery'].append(li_cost)
 
         co2_cost = self.parameters['cost_co2'].values[0] * df_co2['co2'][-1]
-        cost_dict['co2'].append(co2_cost)
+        cost_dict.put('co2', co2_cost)
 
-        total_cost = np.sum([val[-1] for key, val in cost_dict.items() if key != 'total_cost'])
-        cost_dict['total_cost'].append(total_cost)
+        total_cost = np.sum(cost_dict.last_row().values) # total_cost is still 0 in the new row
+        cost_dict.put('total_cost', total_cost)
 
         return cost_dict
         
@@ -1135,3 +1243,290 @@ class Microgrid:
             penalty += abs(self._df_record_control_dict[i][-1] - self._df_record_actual_production[i][-1])
 
         return penalty*coef
+
+class VecMicrogrid:
+    """
+    The class VecMicrogrid steps N microgrids in lockstep. It is used to evaluate an agent on many scenarios or storage
+    sizings at once: the operation of Microgrid.actions_agent and Microgrid.run is written as NumPy operations over
+    the batch and the storage devices of every microgrid are held in one StorageBank.
+
+    Parameters
+    ----------
+    microgrids : Microgrid or list of Microgrid
+        Scenarios to simulate. They must have a grid and a genset, the same status keys and the same storage devices.
+    caps: array, optional
+        (N, n_devices) storage capacities in registry order. A single microgrid is repeated once per row, otherwise
+        there is one row per microgrid. By default the capacities and state of the microgrid devices are used.
+
+    Attributes
+    ----------
+    n: int
+        Number of environments.
+    obs_keys: tuple
+        Key of each observation column, as Microgrid.obs_fields.
+    bank: StorageBank
+        Storage devices of every environment, one row per environment.
+    done: array
+        (N,) Whether each environment has reached the end of its episode.
+    total_cost: array
+        (N,) Cost of operation of each environment since the last reset.
+    total_co2: array
+        (N,) co2 emissions of each environment since the last reset.
+
+    Notes
+    -----
+    reset and step return the same values as Microgrid.reset and Microgrid.run, one row per environment, except that
+    the storage fields of the first observation come from the devices and not from the first status row.
+    Environments that are done are left as they are, with a reward of 0, until the next reset. reset restores the
+    storage state the devices had when the VecMicrogrid was built.
+
+    Examples
+    --------
+    >>> env = VecMicrogrid(m_gen.microgrids[0], caps=np.full((64, 3), 2E5))
+    >>> obs = env.reset()
+    >>> while not env.done.all():
+    >>>     obs, reward, done = env.step(np.random.randint(0, len(env.microgrids[0].agent_actions), env.n))
+    """
+    SERIES = ('load', 'pv', 'grid_status', 'grid_price_import', 'grid_price_export', 'grid_co2') # as Microgrid._series
+
+    def __init__(self, microgrids, caps=None):
+        if isinstance(microgrids, Microgrid):
+            microgrids = [microgrids]
+        microgrids = list(microgrids)
+        if caps is not None:
+            caps = np.array(caps, dtype=float, ndmin=2)
+            if len(microgrids) == 1:
+                microgrids = microgrids * len(caps)
+            elif len(microgrids) != len(caps):
+                raise ValueError('caps has {} rows for {} microgrids'.format(len(caps), len(microgrids)))
+        first = microgrids[0]
+        self.microgrids = tuple(microgrids)
+        self.n = len(microgrids)
+        self.obs_keys = first.obs_fields
+        self._cost_keys = tuple(first._df_record_cost.keys())
+        names = tuple(first.ss.storage_suite)
+        for mg in microgrids:
+            if mg.architecture['grid'] != 1 or mg.architecture['genset'] != 1:
+                raise ValueError('VecMicrogrid needs microgrids with a grid and a genset, like Microgrid.actions_agent')
+            if mg.obs_fields != self.obs_keys or tuple(mg.ss.storage_suite) != names:
+                raise ValueError('The microgrids must have the same status keys and storage devices')
+            if mg.timestep != first.timestep:
+                raise ValueError('The microgrids must have the same timestep')
+        self.timestep = first.timestep
+        self._step_hours = first._step_hours
+
+        # one data set per distinct microgrid object, shared by the environments that simulate it
+        scenarios = list({id(mg): mg for mg in microgrids}.values())
+        self._scenarios = scenarios
+        self._scenario = np.array([scenarios.index(mg) for mg in microgrids])
+        self._data = {}
+
+        if caps is None:
+            self.bank = StorageBank.from_suites([mg.ss for mg in microgrids])
+        else:
+            self.bank = StorageBank(first.ss.device_specs, [first.ss.storage_suite[name].TYPE for name in names], caps)
+        self._initial_storage = (self.bank.soc.copy(), self.bank.peak_time.copy(), self.bank.engaged.copy())
+        # storage controls: the charge of the devices in registry order, then their discharge, as the bank columns
+        self._n_devices = len(names)
+        self._storage_slots = np.concatenate((first._charge_slots, first._discharge_slots))
+        self._share, self._used, self._grid_slot, self._genset_device = _vector_tables(first._action_table, len(names))
+        self._storage_power = np.tile(self.bank.power, 2) # power of each storage control
+        self._direction = np.repeat([-1.0, 1.0], len(names)) # charge controls take -net_load
+        self._rows = np.arange(self.n)
+
+        def param(key):
+            return np.array([mg.parameters[key].values[0] for mg in microgrids], dtype=float)
+        self._cost_loss_load = param('cost_loss_load')
+        self._cost_overgeneration = param('cost_overgeneration')
+        self._cost_co2 = param('cost_co2')
+        self._grid_power_import = param('grid_power_import')
+        self._grid_power_export = param('grid_power_export')
+        self._genset_pmin = param('genset_rated_power') * param('genset_pmin')
+        self._genset_pmax = param('genset_rated_power') * param('genset_pmax')
+        self._fuel_cost = param('fuel_cost')
+        self._genset_co2 = param('genset_co2')
+        self._horizon = np.array([mg.horizon for mg in microgrids], dtype=float)
+        self._first_status = np.array([[mg._df_record_state[key][0] for key in self.obs_keys] for mg in microgrids],
+                                      dtype=float)
+
+        # status key -> (observation columns, columns of the value), device fields have one column per device
+        self._status_columns = {}
+        for key in ('load', 'pv', 'hour', 'grid_co2', 'grid_price_import', 'grid_price_export'):
+            if key in self.obs_keys:
+                self._status_columns[key] = ([self.obs_keys.index(key)], None)
+        for key in ('soc', 'capa_to_charge', 'capa_to_discharge'):
+            fields = [storage_prefixes(name)[1] + '_' + key for name in names]
+            present = [k for k, field in enumerate(fields) if field in self.obs_keys]
+            self._status_columns[key] = ([self.obs_keys.index(fields[k]) for k in present], present)
+        self._obs = np.zeros((self.n, len(self.obs_keys)))
+        self._control = np.zeros((self.n, len(first.control_layout)))
+        self.done = np.ones(self.n, dtype=bool)
+        self.total_cost = np.zeros(self.n)
+        self.total_co2 = np.zeros(self.n)
+        self._t = 0
+
+    def _data_set(self, testing):
+        """ Returns the (T, len(SERIES), n scenarios) series of the data set used by each scenario, nan past its end,
+        and the (N,) data length of each environment. """
+        if testing not in self._data:
+            arrays, lengths = [], []
+            for mg in self._scenarios:
+                data_set = mg._data_set_to_use_default
+                if testing and data_set == 'training':
+                    data_set = 'testing'
+                series = mg._series[data_set]
+                lengths.append(min(len(series[0]), len(series[1])))
+                arrays.append(series)
+            data = np.full((max(lengths), len(self.SERIES), len(arrays)), np.nan)
+            for s, (series, length) in enumerate(zip(arrays, lengths)):
+                for i, values in enumerate(series):
+                    data[:min(length, len(values)), i, s] = values[:length]
+            self._data[testing] = data, np.array(lengths)[self._scenario]
+        return self._data[testing]
+
+    def _update_variables(self):
+        """ Loads the values of the current time step, and of the next one (nan at the end of the data). """
+        t = self._t
+        self._now = self._series[t][:, self._scenario]
+        if t + 1 < len(self._series):
+            self._next = self._series[t + 1][:, self._scenario]
+        else:
+            self._next = np.full(self._now.shape, np.nan)
+
+    def reset(self, testing=False) -> np.ndarray:
+        """ Starts a new episode in every environment, returns the (N, obs_dim) first observations. """
+        self._series, self._data_length = self._data_set(testing)
+        self._t = 0
+        self.done = np.zeros(self.n, dtype=bool)
+        self.total_cost = np.zeros(self.n)
+        self.total_co2 = np.zeros(self.n)
+        soc, peak_time, engaged = self._initial_storage
+        self.bank.soc, self.bank.peak_time, self.bank.engaged = soc.copy(), peak_time.copy(), engaged.copy()
+        self._obs[:] = self._first_status
+        self._put_status({}, None)
+        self._update_variables()
+        return self._obs.copy()
+
+    def _put_status(self, status, active):
+        """ Writes status values and the soc and capacities to charge and discharge of the devices in the observations,
+        only in the active rows (all of them if active is None). """
+        bank = self.bank
+        soc = bank.soc
+        status['soc'] = soc
+        status['capa_to_charge'] = bank.cap * (bank.max_soc - soc)
+        status['capa_to_discharge'] = bank.cap * (soc - bank.min_soc)
+        for key, (obs_cols, value_cols) in self._status_columns.items():
+            if key not in status:
+                continue
+            value = status[key][:, None] if value_cols is None else status[key][:, value_cols]
+            if active is None:
+                self._obs[:, obs_cols] = value
+            else:
+                self._obs[:, obs_cols] = np.where(active, value, self._obs[:, obs_cols])
+
+    def decode(self, actions) -> np.ndarray:
+        """ Vectorized Microgrid.actions_agent, returns the (N, len(control_layout)) controls of the (N,) actions.
+        The array is reused by the next call. """
+        actions = np.asarray(actions, dtype=int)
+        load, pv, status = self._now[0], self._now[1], self._now[2]
+        net_load = load - pv
+        bank = self.bank
+        soc, cap = bank.soc, bank.cap
+        # headroom of the charge then the discharge controls, as self._storage_slots
+        signed_load = np.multiply.outer(net_load, self._direction)
+        capacity = np.concatenate((cap * (bank.max_soc - soc), cap * (soc - bank.min_soc)), axis=1)
+        capacity = capacity / self._step_hours # as a power over the step
+        headroom = np.maximum(0, np.minimum(signed_load, np.minimum(capacity, self._storage_power)))
+
+        control = self._control
+        control.fill(0)
+        control[:, _PV_CONSUMMED] = np.minimum(pv, load)
+        control[self._rows, self._grid_slot[actions]] = np.abs(net_load) * status
+        control[:, self._storage_slots] = np.where(self._used[actions], np.minimum(net_load[:, None] / self._share[actions], headroom), 0)
+        empty = np.abs(soc) == bank.min_soc
+        genset = (self._genset_device[actions] & empty).any(axis=1)
+        control[:, _GENSET] = np.where(genset, np.maximum(0, np.minimum(net_load, self._genset_pmax)), 0)
+        return control
+
+    def step(self, actions):
+        """
+        Runs one time step in every environment that is not done.
+
+        Parameters
+        ----------
+        actions : array
+            (N,) agent actions decoded as in Microgrid.actions_agent, or (N, len(control_layout)) control vectors.
+
+        Returns
+        -------
+        The (N, obs_dim) observations, the (N,) rewards (cost of the step / 4000) and the (N,) done flags.
+        """
+        actions = np.asarray(actions)
+        control = self.decode(actions) if actions.ndim == 1 else np.asarray(actions, dtype=float)
+        active = ~self.done
+        all_active = active.all()
+        load, pv, _, price_import, price_export, grid_co2 = self._now
+
+        # storage devices, a device is only called when it has something to do
+        storage = np.maximum(control[:, self._storage_slots], 0)
+        if not all_active:
+            storage = np.where(active[:, None], storage, 0) # the data of finished environments can be nan
+        n_devices = self._n_devices
+        if ((storage[:, :n_devices] > 0) & (storage[:, n_devices:] > 0)).any():
+            raise ValueError("Cannot charge and discharge in the same timestep. Check your actions for conflicts")
+        bank = self.bank
+        power = storage[:, :n_devices] - storage[:, n_devices:]
+        if not all_active: # finished environments keep their devices as they are
+            engaged = bank.engaged
+        if self.timestep is None:
+            grid_side, _ = bank.dispatch(power)
+        else:
+            grid_side, _ = bank.dispatch_interval(power, self.timestep)
+        if not all_active:
+            bank.engaged = np.where(active[:, None], bank.engaged, engaged)
+        grid_side = grid_side / self._step_hours # mean powers of the step
+        used, delivered = np.maximum(grid_side, 0), np.maximum(-grid_side, 0)
+
+        p_import = np.minimum(np.maximum(control[:, _GRID_IMPORT], 0), self._grid_power_import)
+        p_export = np.minimum(np.maximum(control[:, _GRID_EXPORT], 0), self._grid_power_export)
+        p_genset = np.maximum(control[:, _GENSET], 0)
+        p_genset = np.where((p_genset < self._genset_pmin) & (p_genset > 1), self._genset_pmin, p_genset)
+        p_genset = np.minimum(p_genset, self._genset_pmax)
+
+        # same order of operations as Microgrid._record_production
+        sources = delivered.sum(axis=1) + p_import + p_genset
+        sinks = load + used.sum(axis=1) + p_export
+        pv_required = sinks - sources
+        meeting = np.abs(pv_required - pv) < 1e-3
+        loss = ~meeting & (pv_required > pv)
+        curtail = ~meeting & ~loss & (0 < pv_required) & (pv_required < pv)
+        over = ~(meeting | loss | curtail)
+        loss_load = np.where(loss, pv_required - pv, 0)
+        overgeneration = np.where(over, -pv_required, 0) / 4_000
+
+        co2 = p_genset * self._genset_co2 + grid_co2 * p_import
+        costs = {'loss_load': loss_load * self._cost_loss_load,
+                 'overgeneration': overgeneration * self._cost_overgeneration,
+                 'co2': self._cost_co2 * co2,
+                 'grid_import': price_import * p_import,
+                 'grid_export': - price_export * p_export,
+                 'genset': p_genset * self._fuel_cost}
+        cost = sum(costs[key] for key in self._cost_keys if key in costs) # columns of the cost record, in order
+        if not all_active:
+            cost, co2 = np.where(active, cost, 0), np.where(active, co2, 0)
+        self.total_cost += cost
+        self.total_co2 += co2
+
+        # next status, as Microgrid._update_status
+        t = self._t
+        next_load, next_pv, _, _, _, next_co2 = self._next
+        status = {'load': next_load, 'pv': next_pv, 'hour': np.full(self.n, t % 4), 'grid_co2': next_co2,
+                  'grid_price_import': (0.11/4_000)*p_import, 'grid_price_export': (0.05/4_000)*p_export}
+        self._put_status(status, None if all_active else active[:, None])
+
+        self.done = self.done | (active & ((t == self._horizon) | (t == self._data_length - 1)))
+        if not self.done.all():
+            self._t += 1
+            self._update_variables()
+
+        return self._obs.copy(), cost / 4_000, self.done.copy()
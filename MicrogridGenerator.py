@@ -303,17 +303,14 @@ class MicrogridGenerator:
         # penetragion = peak pv / peak load
         pv=load.max().values[0]*(np.random.randint(low=30, high=151)/100)
         
-        self.li_battery, self.flow_battery, self.flywheel = self.ss.unpack() # These are objects of the Storage class
-        
         size={
             'pv': pv,
             'load': size_load,
-            'li_battery': self.li_battery.cap,
-            'flow_battery': self.flow_battery.cap,
-            'flywheel': self.flywheel.cap,
             'genset': self._size_genset(load),
             'grid': int(max(load.values)*2),
         }
+        for device in self.ss.devices: # capacity of every storage device, by registry name
+            size[device.name] = device.cap
         return size
 
     def _size_genset(self, load, max_operating_loading = 0.9):
@@ -345,6 +342,13 @@ class MicrogridGenerator:
         and then size the other components of the microgrid depending on the load size. This function also initializes
         the tracking dataframes to be used in microgrid.
         """
+        return Microgrid.Microgrid(microgrid_spec = self._create_microgrid_spec(idx))
+
+    def _create_microgrid_spec(self, idx):
+        """
+        Function used to create the microgrid_spec dictionary of one microgrid (see _create_microgrid), so that the
+        same scenario can be reused with other storage suites.
+        """
 
         # get the sizing data
         # create microgrid object and append
@@ -393,44 +397,16 @@ class MicrogridGenerator:
 # Logic for new storage types
 ##############
 
-        self.li_battery.capa_to_charge
-        self.li_battery.capa_to_discharge
-
-        self.flow_battery.capa_to_charge
-        self.flow_battery.capa_to_discharge
-
-        self.flywheel.capa_to_charge
-        self.flywheel.capa_to_discharge
-
-        ################ Lithium Ion Battery ###################
-        column_actual_production.append('li_ion_charge')
-        column_actual_production.append('li_ion_discharge')
-        column_actions.append('li_ion_charge')
-        column_actions.append('li_ion_discharge')
-        df_status['li_ion_soc'] = [self.li_battery.soc]
-        df_status['li_ion_capa_to_charge'] = [self.li_battery.capa_to_charge]
-        df_status['li_ion_capa_to_discharge'] = [self.li_battery.capa_to_discharge]
-        ########################################################################################
-
-        ################ Ion Flow Battery ###################
-        column_actual_production.append('flow_charge')
-        column_actual_production.append('flow_discharge')
-        column_actions.append('flow_charge')
-        column_actions.append('flow_discharge')
-        df_status['flow_soc'] = [self.flow_battery.soc]
-        df_status['flow_capa_to_charge'] = [self.flow_battery.capa_to_charge]
-        df_status['flow_capa_to_discharge'] = [self.flow_battery.capa_to_discharge]
-        ########################################################################################
-
-        ################ Flywheel Energy Storage ###################
-        column_actual_production.append('flywheel_charge')
-        column_actual_production.append('flywheel_discharge')
-        column_actions.append('flywheel_charge')
-        column_actions.append('flywheel_discharge')
-        df_status['flywheel_soc'] = [self.flywheel.soc]
-        df_status['flywheel_capa_to_charge'] = [self.flywheel.capa_to_charge]
-        df_status['flywheel_capa_to_discharge'] = [self.flywheel.capa_to_discharge]
-        ########################################################################################
+        # every storage device of the suite, in registry order, see Microgrid.storage_prefixes for the column names
+        for device in self.ss.devices:
+            _, prefix = Microgrid.storage_prefixes(device.name)
+            column_actual_production.append(prefix + '_charge')
+            column_actual_production.append(prefix + '_discharge')
+            column_actions.append(prefix + '_charge')
+            column_actions.append(prefix + '_discharge')
+            df_status[prefix + '_soc'] = [device.soc]
+            df_status[prefix + '_capa_to_charge'] = [device.capa_to_charge]
+            df_status[prefix + '_capa_to_discharge'] = [device.capa_to_discharge]
 
 
         grid_spec=0
@@ -500,9 +476,8 @@ class MicrogridGenerator:
             # 'flywheel_cap': f'{self.flywheel.cap} Wh'
         }
         # print(f'New Grid\nli_cap: {self.li_battery.cap} Wh\nflow_cap: {self.flow_battery.cap} Wh\nflywheel_cap: {self.flywheel.cap} Wh')
-        microgrid = Microgrid.Microgrid(microgrid_spec = microgrid_spec)
 
-        return microgrid
+        return microgrid_spec
     ########################################################
     # PRINT / PLOT FUNCTIONS
     ########################################################
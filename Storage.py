@@ -1,8 +1,16 @@
 import csv
+import re
+import copy
 import ast
+import io
+import os
+import hashlib
+import json
 import operator as op
-from math import e
-import gc
+from math import e, copysign, sqrt
+from types import MappingProxyType
+from typing import Mapping, NamedTuple
+import numpy as np
 ############
 ''' the following is a string -> evaluation parser '''
 operators = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
@@ -24,8 +32,162 @@ def eval_(node) -> float:
         return operators[type(node.op)](eval_(node.operand))
     else:
         raise TypeError(node)
+
+def _fold(node) -> ast.AST:
+    ''' Checks a formula node against the same whitelist as eval_ and folds its constant sub-expressions '''
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return ast.Constant(float(node.value))
+    elif isinstance(node, ast.Name): # x, y or Euler's number
+        if node.id == 'e':
+            return ast.Constant(e)
+        if node.id in ('x', 'y'):
+            return ast.Name(id=node.id, ctx=ast.Load())
+        raise TypeError(node)
+    elif isinstance(node, ast.BinOp) and type(node.op) in operators:
+        left, right = _fold(node.left), _fold(node.right)
+        if isinstance(left, ast.Constant) and isinstance(right, ast.Constant):
+            try:
+                return ast.Constant(float(operators[type(node.op)](left.value, right.value)))
+            except (ArithmeticError, TypeError): # left for evaluation time, like eval_ would
+                pass
+        return ast.BinOp(left=left, op=node.op, right=right)
+    elif isinstance(node, ast.UnaryOp) and type(node.op) in operators:
+        operand = _fold(node.operand)
+        if isinstance(operand, ast.Constant):
+            return ast.Constant(operators[type(node.op)](operand.value))
+        return ast.UnaryOp(op=node.op, operand=operand)
+    else:
+        raise TypeError(node)
+
+def _empty_formula(x=0.0, y=0.0) -> None:
+    return None
+
+class _SignedConstants(ast.NodeTransformer):
+    ''' Writes negative constants as a negation, so that unparse puts them in parentheses where it matters: a
+        folded (-2)**x would otherwise read back as -2**x '''
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        if copysign(1.0, node.value) < 0:
+            return ast.UnaryOp(op=ast.USub(), operand=ast.Constant(-node.value))
+        return node
+
+def fold_expr(expr: str) -> str:
+    ''' Returns the checked and constant-folded source of a device formula, '' when it is empty.
+        compile_expr gives the same function for the folded source as for the formula. '''
+    expr = expr.replace("'", "") if expr is not None else ''
+    if expr.strip() == '':
+        return ''
+    return ast.unparse(_SignedConstants().visit(_fold(ast.parse(expr, mode='eval').body)))
+
+def compile_expr(expr: str):
+    ''' Compiles a device formula in x and y once into a callable f(x, y).
+        Same grammar as eval_expr, but the string is parsed, checked and constant-folded a single time
+        so evaluating the formula afterwards is a plain Python function call. '''
+    return _compile_source(fold_expr(expr))
+
+def _compile_source(source: str):
+    ''' Compiles a folded source of fold_expr, which must have passed _fold, into a callable f(x, y) '''
+    if source == '':
+        return _empty_formula
+    return eval(compile(f'lambda x=0.0, y=0.0: ({source})', '<formula>', 'eval'), {'__builtins__': {}})
+
+def _check_source(source: str) -> None:
+    ''' Raises SyntaxError or TypeError unless source is a formula of the eval_expr grammar, as _fold would '''
+    if source != '':
+        _fold(ast.parse(source, mode='eval').body)
+
+CURVE_FORMULAS = ('eff_charge', 'eff_discharge', 'self_discharge') # formulas of SoC, keys of the CSV row
+
+def _curve(formula, soc: np.ndarray) -> np.ndarray:
+    values = formula(soc)
+    if values is None: # empty formula in the data file
+        return np.full(soc.shape, np.nan)
+    return np.array(np.broadcast_to(values, soc.shape), dtype=float) # constant formulas come back as a float
+
+def evaluate_curves(data: dict, soc) -> dict:
+    ''' Evaluates the SoC dependent formulas of one parsed CSV row over a whole array of SoC values '''
+    soc = np.asarray(soc, dtype=float)
+    return {name: _curve(compile_expr(data[name]), soc) for name in CURVE_FORMULAS}
+
+def load_device_data(filename) -> dict:
+    ''' Parses a storage device behavior data file into a dict of rows keyed by device type '''
+    with open(filename, newline='', encoding='utf-8-sig') as devices_file: # opens storage data file
+        return _parse_device_data(devices_file)
+
+def _parse_device_data(devices_file) -> dict:
+    device_data = {}
+    reader = csv.DictReader(devices_file)
+    for row in reader:
+        if row['type']: # skips the blank padding rows of older data files
+            device_data[row['type']] = row
+    return device_data
 ############
 
+DEFAULT_DEVICES = ('li-ion', 'flow', 'flywheel') # device types of the baseline StorageSuite, load/3 each
+LUT_POINTS = 33 # default grid size of a CurveTable before refinement
+LUT_MAX_POINTS = 65_537 # refinement stops here even if max_error is not reached
+LUT_MAX_ROWS = 128 # StorageBank evaluates the formulas themselves above this many rows, where np.interp is slower
+ENERGY_POINTS = 4_097 # SoC grid of the energy <-> SoC tables of SoC dependent efficiencies
+CYCLE_BINS = 10 # default number of rainflow cycle depth bins over [0, 1] SoC
+SENSITIVITY_STEP = 1e-6 # relative step of the numeric derivatives of the formulas
+HOUR_SECONDS = 3_600 # the interval methods take powers in W over seconds, the devices count energy in Wh
+
+class CurveTable:
+    ''' Linear interpolation lookup table of a compiled SoC formula.
+        np.interp answers an array of up to a few hundred SoC values faster than a compiled formula of the data
+        files, but a single value takes longer to look up than to compute, so DeviceSpec only uses tables for
+        arrays (see LUT_MAX_ROWS).
+
+        Parameters
+        ----------
+            - formula: callable f(x), compiled formula of SoC
+            - lo: float, lower end of the sampled SoC range
+            - hi: float, upper end of the sampled SoC range
+            - points: int, number of grid points
+            - max_error: float, maximum absolute interpolation error; the grid is doubled until it is met
+
+        Attributes
+        ----------
+            - self.points: int, number of grid points actually used
+            - self.error: float, largest interpolation error measured between grid points, None without max_error
+    '''
+    def __init__(self, formula, lo: float, hi: float, points: int = LUT_POINTS, max_error: float = None) -> None:
+        self.formula = formula
+        self.lo = float(lo)
+        self.hi = float(hi)
+        points = max(int(points), 2)
+        while True:
+            grid = np.linspace(self.lo, self.hi, points)
+            values = np.array(np.broadcast_to(formula(grid), grid.shape), dtype=float)
+            if max_error is None: # the grid is given, nothing to measure
+                self.error = None
+                break
+            fine = np.linspace(self.lo, self.hi, 4 * (points - 1) + 1) # three checkpoints inside every cell
+            exact = np.broadcast_to(formula(fine), fine.shape)
+            self.error = float(np.max(np.abs(np.interp(fine, grid, values) - exact)))
+            if self.error <= max_error or points >= LUT_MAX_POINTS:
+                break
+            points = 2 * points - 1 # keeps the previous grid points
+        self.points = points
+        self.grid = grid
+        self.values = values
+        self._last = points - 2
+        self._inv_step = (points - 1) / (self.hi - self.lo) if self.hi > self.lo else 0.0
+        self._x = grid.tolist() # python floats are faster than numpy scalars in the per-step path
+        self._y = values.tolist()
+        self._slope = (np.diff(values) / np.diff(grid)).tolist() if self.hi > self.lo else [0.0]
+
+    def __call__(self, x, y=0.0):
+        if isinstance(x, np.ndarray):
+            return np.interp(x, self.grid, self.values)
+        if x <= self.lo:
+            return self._y[0]
+        if x >= self.hi:
+            return self._y[-1]
+        i = int((x - self.lo) * self._inv_step)
+        if i > self._last:
+            i = self._last
+        return self._y[i] + self._slope[i] * (x - self._x[i])
+
 
 class StorageSuite:
     ''' StorageSuite aggregates all Storage objects so that they can be interacted in a straightforward manner
@@ -34,16 +196,24 @@ class StorageSuite:
         ----------
             - filename: str, name of storage device behavior data file
             - load: int, measure of max power used by grid in W (J/s)
+            - lut_points, lut_max_error: optional, LUT mode settings of the device specs
+            - cache: bool, keep the parsed and folded catalog in a <filename>.cache file (see load_device_catalog)
+            - devices: optional, list of device types or dict of instance name -> device type, 'all' for one device
+                       per type in the data file; defaults to the DEFAULT_DEVICES types of the data file, in file
+                       order. Repeated types get the names type_2, type_3, ...
 
         Attributes
         ----------
             - self.device_data: dict, parsed data from input file
-            - self.storage_suite: dict, Dictionnary containing all Storage class objects
+            - self.device_specs: dict, one immutable DeviceSpec per device type, shared by its Storage objects
+            - self.storage_suite: dict, registry of all Storage class objects (str(instance name) -> Storage)
+            - self.devices: tuple, the Storage objects in registry order, used for the per-step dispatch
+            - self.bank: StorageBank, one row holding the devices during dispatch, see load_bank
             - self.load: int, measure of max power used by grid in W (J/s)
         
         Description
         -----------
-            Each microgrid contains 3 storage objects:
+            A microgrid contains any number of storage objects of the types in the data file, by default 3:
             - Litium Ion Storage
             - Vanadium Flow Storage
             - Flywheel Energy Storage
@@ -62,33 +232,60 @@ class StorageSuite:
             - resp_time
             - max_peak_time 
     '''
-    def __init__(self, filename,load) -> None:
-        self.device_data = {} # the string data from the CSV file
+    def __init__(self, filename,load, lut_points: int = None, lut_max_error: float = None, cache: bool = False,
+                 devices: list or dict = None) -> None:
+        # the string data from the CSV file and one compiled DeviceSpec per type, shared by every Storage of the type
+        self.device_data, self.device_specs = load_device_catalog(filename, lut_points, lut_max_error, cache)
         self.storage_suite = {} # where the Storage objects are stored (str(name) -> Storage)
+        self.devices = ()
+        self.bank = None # built by load_bank on the first dispatch
         self.load = load
-        with open(filename, newline='', encoding='utf-8-sig') as devices_file: # opens storage data file
-            reader = csv.DictReader(devices_file)
-            for row in reader:
-                self.device_data[row['type']] = row
-        baseline_capacity_dict ={  'li-ion': load/3,
-                                    'flow': load/3,
-                                    'flywheel': load/3
-                                }
-        for device in self.device_data:
-            self.storage_suite[device] = Storage(data=self.device_data[device], type=device, cap = float(baseline_capacity_dict[device]))
-        
+        if devices is None: # the baseline suite
+            devices = [device for device in self.device_data if device in DEFAULT_DEVICES]
+        elif isinstance(devices, str) and devices == 'all':
+            devices = list(self.device_data)
+        if not isinstance(devices, dict):
+            devices = _instance_names(devices)
+        for name, device_type in devices.items():
+            self.register(name, device_type, cap = float(load/len(devices))) # baseline capacity, load split evenly
+
+    def register(self, name: str, device_type: str, cap: float) -> 'Storage':
+        ''' Adds a Storage object of a type from the data file under a new instance name '''
+        if name in self.storage_suite:
+            raise KeyError(f"A storage device named {name} is already registered")
+        if device_type not in self.device_specs:
+            raise KeyError(f"Unknown storage device type {device_type}, the data file has {list(self.device_specs)}")
+        device = Storage(data=self.device_specs[device_type], type=device_type, cap=cap, name=name)
+        self.storage_suite[name] = device
+        self.devices = tuple(self.storage_suite.values())
+        return device
 
     def modify_ss(self, param: list) -> None: # 
-        ''' Takes in a dict containing new power and capacity values, re-initializes all Storage objects '''
-        #print(gc.isenabled())
+        ''' Takes in a list of new capacity values, gives all Storage objects these capacities and their initial state '''
+        self.resize(param, reset_state=True)
+
+    def resize(self, param: list, reset_state: bool = False) -> None:
+        ''' Resizes every Storage object in place to the capacities in param (same order as storage_suite) '''
         for idx, device in enumerate(self.storage_suite):
-            del self.storage_suite[device]
-            try:
-                self.storage_suite[device] = Storage(data = self.device_data[device], type = device, cap = param[idx])#, power=param[device]['power'])
-            except KeyError:
-                self.storage_suite[device] = Storage(data = self.device_data[device], type = device, cap = param[idx])
+            self.storage_suite[device].resize(param[idx], reset_state)
+
+    def fork(self) -> 'StorageSuite':
+        ''' Returns a suite of copies of the devices in their current state (see Storage.fork), sharing the catalog
+            and the bank, which load_bank fills with the state of the calling suite '''
+        suite = StorageSuite.__new__(StorageSuite)
+        suite.__dict__.update(self.__dict__)
+        suite.storage_suite = {name: device.fork() for name, device in self.storage_suite.items()}
+        suite.devices = tuple(suite.storage_suite.values())
+        return suite
 
-        gc.collect()
+    def save_state(self) -> tuple:
+        ''' Returns the dynamic state of every device in registry order, see Storage.save_state '''
+        return tuple(device.save_state() for device in self.devices)
+
+    def restore_state(self, state: tuple) -> None:
+        ''' Puts every device back in a state returned by save_state '''
+        for device, device_state in zip(self.devices, state):
+            device.restore_state(device_state)
 
     def get_capital_cost(self) -> float:
         ''' Returns the total capital cost of all storage devices based on capacity'''
@@ -112,17 +309,91 @@ class StorageSuite:
         for device in self.storage_suite:
             self.storage_suite[device]._print_properties()
 
-    def discharge(self, stor_type, econ_cost = None, energy_requested=None, energy_spent=None) -> float:
-        ''' attempts to discharge a given device based on the usable amount wanted or the amount to remove from the device '''
-        device = self.storage_suite[stor_type]
-        device.discharge(econ_cost, energy_requested, energy_spent)
-        return energy_requested
+    def discharge(self, stor_type, econ_cost = None, power_requested=None, power_spent=None) -> tuple:
+        ''' attempts to discharge a given device based on the usable amount wanted or the amount to remove from the device
+            Returns the (requested, spent) amounts actually applied, see Storage._discharge '''
+        return self.storage_suite[stor_type]._discharge(econ_cost, power_requested, power_spent)
+
+    def charge(self, stor_type, econ_cost=None, power_used=None, power_stored=None) -> tuple:
+        ''' attempts to charge a given device based on the usable amount wanted or the amount to supply to the device
+            Returns the (used, stored) amounts actually applied, see Storage._charge '''
+        return self.storage_suite[stor_type]._charge(econ_cost, power_used, power_stored)
+
+    def dispatch(self, power, econ_cost = None) -> tuple:
+        ''' Charges (power > 0) or discharges (power < 0) every device in one call, see StorageBank.dispatch
+            power holds one signed grid side value per device, in registry order.
+            Returns two arrays: grid side energy (positive in) and device side energy (positive stored). '''
+        return self._dispatch(power, None, econ_cost)
+
+    def dispatch_interval(self, power, dt: float, econ_cost = None) -> tuple:
+        ''' dispatch over an interval of dt seconds, see StorageBank.dispatch_interval
+            power holds one signed value per device in W. Devices with a zero entry are idle for the interval.
+            Returns the same arrays as dispatch, the energies over the interval in Wh. '''
+        return self._dispatch(power, dt, econ_cost)
+
+    def _dispatch(self, power, dt: float, econ_cost) -> tuple:
+        ''' Steps every device at once in the bank and writes the new state back to the Storage objects.
+            The cycle and sensitivity trackers of the devices that have them are updated afterwards. '''
+        power = np.asarray(power, dtype=float)
+        bank = self.load_bank()
+        soc = bank.soc[0].tolist()
+        if dt is None:
+            grid_side, device_side = bank.dispatch(power)
+        else:
+            grid_side, device_side = bank.dispatch_interval(power, dt)
+        grid_side, device_side = grid_side[0], device_side[0]
+        for device, device_soc, peak_time, engaged in zip(self.devices, bank.soc[0].tolist(),
+                                                          bank.peak_time[0].tolist(), bank.engaged[0].tolist()):
+            device._soc, device.engaged, device._derived = device_soc, int(engaged), None
+            if peak_time != device.peak_time: # whole seconds stay an int, as in the Storage methods
+                device.peak_time = int(peak_time) if peak_time.is_integer() else peak_time
+        tracked = [idx for idx, device in enumerate(self.devices)
+                   if device.rainflow is not None or device.sensitivity is not None]
+        if tracked:
+            self._update_trackers(tracked, soc, power, grid_side, device_side)
+        if econ_cost != None:
+            econ_cost.cost += float(np.dot(bank.marginal_cost[0], np.abs(grid_side)))
+        return grid_side, device_side
+
+    def _update_trackers(self, tracked: list, soc: list, power: np.ndarray, grid_side: np.ndarray,
+                         device_side: np.ndarray) -> None:
+        ''' Feeds the dispatch of the tracked devices to their trackers, as Storage._charge and Storage._discharge do '''
+        for idx in tracked:
+            device, command = self.devices[idx], power[idx]
+            if command == 0 or (command < 0 and soc[idx] == device.MIN_SOC): # the device was not stepped
+                if device.sensitivity is not None:
+                    device.sensitivity.dcommand = 0.0
+                continue
+            if device.sensitivity is not None:
+                if command > 0:
+                    device.sensitivity.charge(device, soc[idx], grid_side[idx], device._soc == device.MAX_SOC, False)
+                else:
+                    device.sensitivity.discharge(device, soc[idx], -device_side[idx], device._soc == device.MIN_SOC, False)
+            if device.rainflow is not None:
+                device.rainflow.update(device._soc)
+
+    def load_bank(self) -> 'StorageBank':
+        ''' Returns self.bank, a StorageBank with one row holding the devices in registry order, loaded with
+            their current state. It is built again when the devices or their capacities changed. '''
+        bank, devices = self.bank, self.devices
+        caps = [device._cap for device in devices]
+        if bank is None or bank.cap[0].tolist() != caps:
+            self.bank = StorageBank.from_suites([self])
+            return self.bank
+        bank.soc[0] = [device._soc for device in devices]
+        bank.peak_time[0] = [device.peak_time for device in devices]
+        bank.engaged[0] = [device.engaged for device in devices]
+        return bank
 
-    def charge(self, stor_type, econ_cost=None, energy_used=None, energy_stored=None) -> float:
-        ''' attempts to charge a given device based on the usable amount wanted or the amount to supply to the device '''
-        device = self.storage_suite[stor_type]
-        device.charge(econ_cost, energy_used, energy_stored)
-        return energy_used
+    def get_storage_status(self) -> tuple:
+        ''' Returns the (soc, capa_to_charge, capa_to_discharge) arrays of the devices in registry order '''
+        bank = self.load_bank()
+        soc, cap = bank.soc[0], bank.cap[0]
+        return soc, cap * (bank.max_soc[0] - soc), cap * (soc - bank.min_soc[0])
+
+    def get_headrooms(self) -> dict:
+        ''' Returns (charge headroom, discharge headroom) in grid side energy for every device, see Storage.charge_headroom '''
+        return {device.name: (device.charge_headroom(), device.discharge_headroom()) for device in self.devices}
 
     def get_device_capital_costs(self, title = False) -> list or dict:
         if not title:
@@ -133,9 +404,9 @@ class StorageSuite:
                 cost_list.append(properties[device]['capital_cost'])
             return cost_list
         else:
-            # Returns a dict of all costs with storage type names as keys
+            # Returns a dict of all costs with storage instance names as keys
             properties = self.get_properties()
-            cost_dict = {"li-ion": 0, "flow": 0, "flywheel": 0}
+            cost_dict = {}
             for device in self.storage_suite:
                 cost_dict[device] = properties[device]['capital_cost']
             return cost_dict
@@ -153,13 +424,49 @@ class StorageSuite:
         for device in self.storage_suite:
             self.storage_suite[device]._self_discharge()
 
+    def fast_forward_idle_all(self, n_steps: int) -> None:
+        ''' self-discharges all devices over n_steps idle steps in one call each, within the error bound of
+            Storage.fast_forward_idle '''
+        for device in self.storage_suite:
+            self.storage_suite[device].fast_forward_idle(n_steps)
+
+    def apply_schedule(self, power, inplace: bool = False) -> dict:
+        ''' Runs a (steps, devices) signed schedule, one column per device in registry order,
+            through Storage.apply_schedule and returns its result arrays keyed by device name '''
+        power = np.asarray(power, dtype=float).reshape(-1, len(self.devices))
+        return {device.name: device.apply_schedule(power[:, idx], inplace) for idx, device in enumerate(self.devices)}
+
+    def track_cycles(self, bins: int = CYCLE_BINS) -> None:
+        ''' Starts a rainflow cycle counter on every device '''
+        for device in self.devices:
+            device.track_cycles(bins)
+
+    def get_cycle_histograms(self, include_residual: bool = True) -> dict:
+        ''' Returns the (bin edges, cycle counts) rainflow histogram of every tracked device '''
+        return {device.name: device.rainflow.histogram(include_residual) for device in self.devices
+                if device.rainflow is not None}
+
+    def track_sensitivity(self) -> None:
+        ''' Starts propagating capacity sensitivities on every device, see CapSensitivity '''
+        for device in self.devices:
+            device.track_sensitivity()
+
+    def get_cap_sensitivities(self) -> dict:
+        ''' Returns the CapSensitivity of every tracked device '''
+        return {device.name: device.sensitivity for device in self.devices if device.sensitivity is not None}
+
+    def capital_cost_gradient(self, caps) -> np.ndarray:
+        ''' Derivative of each device capital cost with respect to its own capacity, same shape as caps
+            (see capital_cost_surface); the total capital cost gradient since devices are costed separately. '''
+        caps = np.asarray(caps, dtype=float)
+        step = SENSITIVITY_STEP * np.maximum(np.abs(caps), 1.0)
+        upper = self.capital_cost_surface(caps + step)['capital_cost']
+        lower = self.capital_cost_surface(caps - step)['capital_cost']
+        return (upper - lower) / (2 * step)
+
     def get_status_variables(self) -> dict:
         ''' Returns values that change within one microgrid ''' 
-        variables = {  'li-ion': {}, 
-                        'flywheel': {},
-                        # 'v2g': {},
-                        'flow': {}
-                        }
+        variables = {device: {} for device in self.storage_suite}
         for device in self.storage_suite:
             self.storage_suite[device]._get_state(variables)
 
@@ -167,14 +474,18 @@ class StorageSuite:
 
     def get_properties(self) -> dict:
         ''' Returns values that stay the same within one microgrid ''' 
-        properties = {  'li-ion': {}, 
-                        'flow': {},
-                        'flywheel': {}
-                        }
+        properties = {device: {} for device in self.storage_suite}
         for device in self.storage_suite:
             self.storage_suite[device]._get_properties(properties)
         return properties
 
+    def evaluate_curves(self, soc) -> dict:
+        ''' Returns the efficiency and self-discharge curves of every device over an array of SoC values '''
+        curves = {}
+        for device in self.storage_suite:
+            curves[device] = self.storage_suite[device].evaluate_curves(soc)
+        return curves
+
     def get_total_capital_cost(self) -> float:
         cost: float = 0
         properties = self.get_properties()
@@ -183,122 +494,897 @@ class StorageSuite:
         return cost
 
     def get_total_capital_cost_formula(self) -> str:
-        li_ion, flow, flywheel = self.unpack()
-        li_formula = li_ion.FORMULA_CAPITAL_COST.replace("x", "L").replace("y", str(li_ion.FORMULA_POWER.replace("self.cap", "L"))).replace("'", "")
-        flow_formula = flow.FORMULA_CAPITAL_COST.replace("x", "F").replace("y", str(flow.FORMULA_POWER.replace("self.cap", "F"))).replace("'", "")
-        flywheel_formula = flywheel.FORMULA_CAPITAL_COST.replace("x", "W").replace("y", str(flywheel.FORMULA_POWER.replace("self.cap", "W"))).replace("'", "") 
-        return li_formula + "+" + flow_formula + "+" + flywheel_formula
-
-    def unpack(self) -> object:
-        """ Returns the objects of the different storage types. """
-        mg_stats = self.get_properties()
-        mg_variables = self.get_status_variables()
-        for key in mg_stats:                                    # 
-            if key in mg_variables:                             # Merges dicts together for grid ceation
-                mg_stats[key].update(mg_variables[key])         #
-        
-        li_battery = self.storage_suite['li-ion']
-        flow_battery = self.storage_suite['flow']
-        flywheel = self.storage_suite['flywheel']
+        ''' Total capital cost as a formula of one capacity symbol per device (L, F, W for the default devices, C<idx> otherwise) '''
+        formulas = []
+        for idx, (name, device) in enumerate(self.storage_suite.items()):
+            symbol = DEVICE_SYMBOLS.get(name, f"C{idx}")
+            formulas.append(device.FORMULA_CAPITAL_COST.replace("x", symbol).replace("y", str(device.FORMULA_POWER.replace("self.cap", symbol))).replace("'", ""))
+        return "+".join(formulas)
+
+    def capital_cost_surface(self, caps) -> dict:
+        ''' Evaluates the sizing formulas over an array of candidate capacities in one vectorized call per device
+            caps has shape (..., number of devices), one capacity in Wh per device in registry order.
+            Returns the per-device 'capital_cost' and 'power' arrays (same shape as caps) and the 'total'
+            capital cost (shape caps.shape[:-1]), with the same values as Storage.capital_cost and Storage.power. '''
+        caps = np.asarray(caps, dtype=float)
+        if caps.shape[-1:] != (len(self.devices),):
+            raise ValueError(f"caps must have one column per device ({len(self.devices)}), received shape {caps.shape}")
+        power, capital_cost = np.empty(caps.shape), np.empty(caps.shape)
+        for idx, device in enumerate(self.devices):
+            cap = caps[..., idx]
+            device_power = device.spec.f_power(cap)
+            power[..., idx] = device_power if device_power is not None else np.nan # empty max_cont_discharge
+            capital_cost[..., idx] = device.spec.f_capital_cost(cap/1000, power[..., idx]/1000)
+        return {'capital_cost': capital_cost, 'power': power, 'total': capital_cost.sum(axis=-1)}
+
+    def new_status_buffer(self) -> np.ndarray:
+        ''' Allocates a record array with one STATUS_DTYPE row per device, to be filled by snapshot '''
+        return np.zeros(len(self.storage_suite), dtype=STATUS_DTYPE)
+
+    def snapshot(self, out: np.ndarray) -> np.ndarray:
+        ''' Writes the values of get_status_variables into a preallocated STATUS_DTYPE record array,
+            one row per device in storage_suite order, without building any dict '''
+        for idx, device in enumerate(self.devices):
+            out[idx] = device._state_row()
+        return out
+
+    def unpack(self, *names) -> object:
+        """ Returns the objects of the named storage devices, li-ion, flow and flywheel by default. """
+        if not names:
+            names = ('li-ion', 'flow', 'flywheel')
+        return tuple(self.storage_suite[name] for name in names)
+
+DEVICE_SYMBOLS = {'li-ion': 'L', 'flow': 'F', 'flywheel': 'W'} # capacity symbols of get_total_capital_cost_formula
+
+def _instance_names(device_types: list) -> dict:
+    ''' Names a list of device types, repeated types become type_2, type_3, ... '''
+    names, seen = {}, {}
+    for device_type in device_types:
+        seen[device_type] = seen.get(device_type, 0) + 1
+        names[device_type if seen[device_type] == 1 else f"{device_type}_{seen[device_type]}"] = device_type
+    return names
+
+# one row of StorageSuite.snapshot, same values as Storage._get_state
+STATUS_DTYPE = np.dtype([('soc', np.float64), ('stored_energy', np.float64), ('eff_charge', np.float64),
+                         ('eff_discharge', np.float64), ('self_discharge', np.float64), ('peak_time_left', np.float64)])
+
+SPEC_FORMULAS = ('max_cont_discharge', 'max_peak_discharge') + CURVE_FORMULAS + ('capital_cost',)
+NONEMPTY_COLUMNS = ('max_charge', 'min_charge') + SPEC_FORMULAS # values of a device row check_device_data requires
+REQUIRED_COLUMNS = ('type', 'marginal_cost', 'resp_time') + NONEMPTY_COLUMNS # columns DeviceSpec.from_row reads
+
+class DeviceSpec(NamedTuple):
+    ''' Immutable description of one storage device type, built once per data file row and shared by
+        every Storage object of that type. Holds the CSV row and its compiled formulas. '''
+    TYPE: str
+    DATA: Mapping # read-only view of the CSV row
+    MAX_SOC: float
+    MIN_SOC: float
+    MARGINAL_COST: float
+    resp_time: str
+    RESP_SECONDS: float # resp_time as a number of seconds
+    INIT_PEAK_TIME: int
+    f_power: object # f(cap), in W
+    f_peak_discharge: object # f(cap, power), in W
+    f_eff_charge: object # f(soc), the compiled formula, for single SoC values
+    f_eff_discharge: object # f(soc), the compiled formula, for single SoC values
+    f_self_discharge: object # f(soc), the compiled formula, for single SoC values
+    array_eff_charge: object # f(soc array) for StorageBank and evaluate_curves, a CurveTable in LUT mode
+    array_eff_discharge: object # f(soc array), a CurveTable in LUT mode
+    array_self_discharge: object # f(soc array), a CurveTable in LUT mode
+    f_capital_cost: object # f(cap in kWh, power in kW)
+    idle_rate: float # SoC lost per idle step when self_discharge is constant, else None
+    idle_table: tuple # (steps, soc) to fall from MAX_SOC, see _idle_table; None if it cannot be built
+    charge_energy: 'EnergyTables' # (soc -> energy, energy -> soc) CurveTables per Wh of capacity, built on first use
+    discharge_energy: 'EnergyTables'
+
+    def __copy__(self) -> 'DeviceSpec':
+        return self
+
+    def __deepcopy__(self, memo: dict) -> 'DeviceSpec':
+        return self # immutable, copies of a Storage keep sharing it
+
+    @classmethod
+    def from_row(cls, data: dict, type: str = None, lut_points: int = None, lut_max_error: float = None,
+                 compiled: dict = None, idle: tuple = None) -> 'DeviceSpec':
+        ''' Compiles a parsed CSV row; lut_points/lut_max_error evaluate the SoC formulas over arrays from CurveTables.
+            compiled (formula name -> callable) and idle ((idle_rate, idle_table)) skip the work already
+            done, as when loading a cached catalog. '''
+        if compiled is None:
+            compiled = {name: compile_expr(data[name]) for name in SPEC_FORMULAS}
+        max_soc = float(data['max_charge']) # maximum charge as a proportion of capacity
+        min_soc = float(data['min_charge']) # minimum charge as a proportion of capacity
+        curves = [compiled[name] for name in CURVE_FORMULAS]
+        idle_rate, idle_table = idle if idle is not None else _idle_table(curves[2], min_soc, max_soc)
+        charge_energy = EnergyTables(curves[0], min_soc, max_soc, charge=True) # from the exact formulas
+        discharge_energy = EnergyTables(curves[1], min_soc, max_soc, charge=False)
+        arrays = curves
+        if lut_points is not None or lut_max_error is not None: # LUT mode, interpolate the SoC formulas of arrays
+            arrays = [_tabulate(formula, min_soc, max_soc, lut_points, lut_max_error) for formula in curves]
+        return cls(TYPE = type if type is not None else data['type'],
+                   DATA = MappingProxyType(dict(data)),
+                   MAX_SOC = max_soc,
+                   MIN_SOC = min_soc,
+                   MARGINAL_COST = float(data['marginal_cost'] or 0), # cost to use device per kWh in/out, in USD (empty means free)
+                   resp_time = data['resp_time'], # time it takes for device to realize command, in seconds
+                   RESP_SECONDS = _parse_seconds(data['resp_time']),
+                   INIT_PEAK_TIME = int(data.get('peak_time') or 0), # empty in some data files
+                   f_power = compiled['max_cont_discharge'],
+                   f_peak_discharge = compiled['max_peak_discharge'],
+                   f_eff_charge = curves[0],
+                   f_eff_discharge = curves[1],
+                   f_self_discharge = curves[2],
+                   array_eff_charge = arrays[0],
+                   array_eff_discharge = arrays[1],
+                   array_self_discharge = arrays[2],
+                   f_capital_cost = compiled['capital_cost'],
+                   idle_rate = idle_rate,
+                   idle_table = idle_table,
+                   charge_energy = charge_energy,
+                   discharge_energy = discharge_energy)
+
+class RainflowCounter:
+    ''' Streaming rainflow cycle counter of a SoC signal
+
+        Parameters
+        ----------
+            - bins: int, number of equal width cycle depth bins over [0, 1]
+
+        Attributes
+        ----------
+            - self.counts: np.ndarray, number of closed full cycles per depth bin
+            - self.stack: list, residual of turning points not closed into full cycles yet
+
+        Description
+        -----------
+            Turning points go through the four point rule as they are confirmed: with a, b, c, d the last
+            four, if |b-c| <= |a-b| and |b-c| <= |c-d| then b-c is a full cycle and b, c are dropped.
+            Every point is pushed and popped at most once, so update is amortized O(1), and only the
+            residual is kept instead of the SoC history. The residual counts as half cycles on demand.
+    '''
+    def __init__(self, bins: int = CYCLE_BINS) -> None:
+        self.bins = bins
+        self.counts = np.zeros(bins)
+        self.stack = []
+        self._tip = None # last point, turning point candidate
+        self._rising = None # direction from the last turning point to the tip
+
+    def update(self, soc: float) -> None:
+        if self._tip is None:
+            self._tip = soc
+            return
+        if soc == self._tip:
+            return
+        rising = soc > self._tip
+        if rising != self._rising: # the tip was a turning point (the start point counts as one)
+            self._rising = rising
+            self._push(self._tip)
+        self._tip = soc
+
+    def _push(self, point: float) -> None:
+        stack = self.stack
+        stack.append(point)
+        while len(stack) >= 4:
+            a, b, c, d = stack[-4], stack[-3], stack[-2], stack[-1]
+            depth = abs(b - c)
+            if depth > abs(a - b) or depth > abs(c - d):
+                break
+            self._count(depth, 1.0)
+            del stack[-3:-1]
+
+    def _count(self, depth: float, cycles: float) -> None:
+        self.counts[min(int(depth * self.bins), self.bins - 1)] += cycles
+
+    def residual(self) -> list:
+        ''' Turning points that are not closed yet, the current SoC last '''
+        return self.stack + ([self._tip] if self._tip is not None else [])
+
+    def histogram(self, include_residual: bool = True) -> tuple:
+        ''' Returns (bin edges, cycle counts); the residual adds half cycles unless include_residual is False '''
+        counts = self.counts
+        if include_residual:
+            closed, self.counts = self.counts, self.counts.copy()
+            points = self.residual()
+            for start, end in zip(points[:-1], points[1:]):
+                self._count(abs(end - start), 0.5)
+            counts, self.counts = self.counts, closed
+        return np.linspace(0, 1, self.bins + 1), counts
+
+    def equivalent_full_cycles(self, include_residual: bool = True) -> float:
+        ''' Sum of cycle depths weighted by count, using the bin centers '''
+        edges, counts = self.histogram(include_residual)
+        return float(np.sum(counts * (edges[:-1] + edges[1:]) / 2))
+
+IDLE_POINTS = 4_097 # SoC grid of the idle fast-forward tables
+IDLE_STEP_LIMIT = 32 # shorter idle stretches are stepped exactly, that is cheaper than the table lookup
+
+class CapSensitivity:
+    ''' Forward-mode sensitivities of one Storage with respect to its capacity
+
+        Attributes
+        ----------
+            - self.dsoc: float, d soc / d cap
+            - self.dused: float, d (grid energy used to charge) / d cap, summed over the steps
+            - self.drequested: float, d (energy delivered to the grid) / d cap, summed over the steps
+            - self.dlost: float, d (self-discharge losses) / d cap, summed over the steps
+            - self.dmarginal_cost: float, d (marginal cost) / d cap, summed over the steps
+            - self.dcommand: float, d (next command) / d cap relative to the command, see command
+
+        Description
+        -----------
+            The commands sent to the device are taken as fixed unless the caller sets their derivative with
+            command, and every _charge, _discharge and _self_discharge step is differentiated through its SoC
+            update and its clamps, using numeric derivatives of the SoC formulas. One simulation gives the
+            derivatives of every device.
+            charge_interval and discharge_interval are differentiated like _charge and _discharge, with the
+            peak and response times taken as fixed. The schedule and fast-forward methods are not differentiated.
+    '''
+    def __init__(self) -> None:
+        self.dsoc = 0.0 # the initial state does not depend on the capacity
+        self.dused = 0.0
+        self.drequested = 0.0
+        self.dlost = 0.0
+        self.dmarginal_cost = 0.0
+        self.dcommand = 0.0
+
+    def command(self, command: float, dcommand: float) -> None:
+        ''' Sets the derivative dcommand of the next charge or discharge command with respect to cap, for a command
+            limited by a capacity dependent quantity (see dpower, dcapa_to_charge and dcapa_to_discharge).
+            The energy of that step scales with the command, so only the ratio is kept; it is used once. '''
+        self.dcommand = dcommand / command if command > 0 else 0.0
+
+    def dpower(self, device: 'Storage') -> float:
+        ''' d power / d cap '''
+        return _derivative(device.spec.f_power, device._cap)
+
+    def dcapa_to_charge(self, device: 'Storage') -> float:
+        ''' d capa_to_charge / d cap '''
+        return device.MAX_SOC - device._soc - device._cap * self.dsoc
+
+    def dcapa_to_discharge(self, device: 'Storage') -> float:
+        ''' d capa_to_discharge / d cap '''
+        return device._soc + device._cap * self.dsoc - device.MIN_SOC
+
+    def charge(self, device: 'Storage', soc: float, power_used: float, full: bool, from_stored: bool) -> None:
+        ''' Step of Storage._charge from soc, power_used being the grid side energy it returned '''
+        cap = device._cap
+        dsoc_cap = soc + cap * self.dsoc
+        dcommand, self.dcommand = self.dcommand, 0.0
+        if full: # power_used = MAX_SOC*cap - soc_cap
+            dused = device.MAX_SOC - dsoc_cap
+            self.dsoc = 0.0
+        else:
+            eff = device._f_eff_charge(soc)
+            deff = _derivative(device._f_eff_charge, soc) * self.dsoc
+            if from_stored: # power_used = power_stored / eff
+                dstored = eff * power_used * dcommand
+                dused = (dstored - power_used * deff) / eff
+            else: # power_stored = eff * power_used
+                dused = power_used * dcommand
+                dstored = deff * power_used + eff * dused
+            self.dsoc = (dsoc_cap + dstored - device._soc) / cap
+        self.dused += dused
+        self.dmarginal_cost += device.MARGINAL_COST * dused
+
+    def discharge(self, device: 'Storage', soc: float, power_spent: float, empty: bool, from_spent: bool) -> None:
+        ''' Step of Storage._discharge from soc, power_spent being the device side energy it returned '''
+        cap = device._cap
+        dsoc_cap = soc + cap * self.dsoc
+        dcommand, self.dcommand = self.dcommand, 0.0
+        if empty: # power_requested = power_spent = soc_cap - MIN_SOC*cap
+            drequested = dsoc_cap - device.MIN_SOC
+            self.dsoc = 0.0
+        else:
+            eff = device._f_eff_discharge(soc)
+            deff = _derivative(device._f_eff_discharge, soc) * self.dsoc
+            if from_spent: # power_requested = eff * power_spent
+                dspent = power_spent * dcommand
+                drequested = deff * power_spent + eff * dspent
+            else: # power_spent = power_requested / eff
+                drequested = eff * power_spent * dcommand
+                dspent = (drequested - power_spent * deff) / eff
+            self.dsoc = (dsoc_cap - dspent - device._soc) / cap
+        self.drequested += drequested
+        self.dmarginal_cost += device.MARGINAL_COST * drequested
+
+    def self_discharge(self, device: 'Storage', soc: float, delta_soc: float, empty: bool) -> None:
+        ''' Step of Storage._self_discharge from soc, delta_soc being the SoC it lost '''
+        if empty: # delta_soc = soc - MIN_SOC
+            ddelta = self.dsoc
+        else:
+            ddelta = _derivative(device._f_self_discharge, soc) * self.dsoc / 1000
+        self.dsoc -= ddelta
+        self.dlost += ddelta * device._cap + delta_soc
+
+def _derivative(formula, x: float) -> float:
+    step = SENSITIVITY_STEP * max(abs(x), 1.0)
+    return (formula(x + step) - formula(x - step)) / (2 * step)
+
+def _parse_seconds(text: str) -> float:
+    ''' Reads the first number of a resp_time entry such as '<1s' or '<1s (or aggregator?)' as seconds,
+        bounds taken as the value; empty means instant '''
+    number = re.search(r'\d*\.?\d+', text or '')
+    return float(number.group()) if number else 0.0
+
+def _idle_speed(formula, soc):
+    ''' SoC lost per step by the ODE dsoc/dstep = -r(soc) * (1 + r'(soc)/2), r = f/1000, which follows the idle steps
+        soc -= r(soc) to second order; the plain ODE dsoc/dstep = -r(soc) loses r'/2 less per step. Takes arrays. '''
+    slope = (formula(soc + SENSITIVITY_STEP) - formula(soc - SENSITIVITY_STEP)) / (2 * SENSITIVITY_STEP) # as _derivative on SoC
+    return formula(soc) / 1000 * (1 + slope / 2000)
+
+def _idle_table(formula, lo: float, hi: float) -> tuple:
+    ''' Integrates the idle self-discharge ODE of _idle_speed once for fast_forward_idle.
+        Returns (idle_rate, None) for a constant rate, else (None, (steps, soc)) where steps[i] is the
+        number of idle steps needed to fall from hi to soc[i], both increasing. The table is None
+        when the rate is not strictly positive on [lo, hi], since then the device never empties. '''
+    probe = formula(np.array([lo, hi]))
+    if probe is None:
+        return 0.0, None
+    if np.ndim(probe) == 0:
+        return float(probe)/1000, None
+    soc = np.linspace(hi, lo, IDLE_POINTS)
+    with np.errstate(all='ignore'):
+        rate = np.asarray(_idle_speed(formula, soc), dtype=float)
+    if not np.all(np.isfinite(rate)) or np.any(rate <= 0):
+        return None, None
+    inv = 1/rate
+    steps = np.concatenate(([0.0], np.cumsum((inv[1:] + inv[:-1]) / 2 * (soc[:-1] - soc[1:]))))
+    return None, (steps, soc)
+
+def _idle_forward(formula, idle_table: tuple, soc: float, n_steps: int) -> float:
+    ''' SoC after n_steps idle steps from soc on the table of _idle_table, None when it runs out below its lowest SoC.
+        The table integrates 1/rate as linear within each cell, and the position inside the first and the last cell
+        is solved for that same profile (a quadratic in SoC) rather than interpolated linearly: a linear
+        interpolation holds the rate constant over the cell, which is off by up to half the change of the rate
+        across the cell. The remaining error is that of the trapezoid rule, about (h * f'/f)**2 / 8 relative with
+        h the cell width. '''
+    steps, grid = idle_table
+    last = len(grid) - 2
+    width = grid[0] - grid[1]
+    i = min(int((grid[0] - soc) / width), last) # the grid falls uniformly from hi to lo
+    top, bottom = 1 / _idle_speed(formula, grid[i]), 1 / _idle_speed(formula, grid[i + 1]) # steps per SoC at the cell ends
+    depth = grid[i] - soc
+    elapsed = steps[i] + top * depth + (bottom - top) * depth * depth / (2 * width) + n_steps
+    if elapsed >= steps[-1]:
+        return None
+    j = min(int(np.searchsorted(steps, elapsed, 'right')) - 1, last)
+    if j != i:
+        top, bottom = 1 / _idle_speed(formula, grid[j]), 1 / _idle_speed(formula, grid[j + 1])
+    rest = elapsed - steps[j]
+    depth = 2 * rest / (top + sqrt(max(top * top + 2 * (bottom - top) * rest / width, 0.0)))
+    return float(grid[j] - depth)
+
+def _energy_tables(formula, lo: float, hi: float, charge: bool) -> tuple:
+    ''' Cumulative grid side energy per Wh of capacity between lo and SoC: the integral of 1/eff for
+        charging, of eff for discharging. Returns CurveTables (soc -> energy, energy -> soc), both on
+        uniform grids so lookups are O(1), or None when the efficiency is empty or not strictly positive. '''
+    probe = formula(np.array([lo, hi]))
+    if probe is None or hi <= lo:
+        return None
+    points = 2 if np.ndim(probe) == 0 else ENERGY_POINTS # linear for a constant efficiency
+    soc = np.linspace(lo, hi, points)
+    with np.errstate(all='ignore'):
+        eff = np.array(np.broadcast_to(formula(soc), soc.shape), dtype=float)
+    if not np.all(np.isfinite(eff)) or np.any(eff <= 0):
+        return None
+    density = 1/eff if charge else eff
+    energy = np.concatenate(([0.0], np.cumsum((density[1:] + density[:-1]) / 2 * np.diff(soc))))
+    to_energy = CurveTable(lambda x, y=0.0: np.interp(x, soc, energy), lo, hi, points)
+    to_soc = CurveTable(lambda x, y=0.0: np.interp(x, energy, soc), 0.0, energy[-1], points)
+    return to_energy, to_soc
+
+class EnergyTables:
+    ''' The (soc -> energy, energy -> soc) tables of _energy_tables, built the first time they are unpacked.
+        Only the headroom and soc_after methods use them, so loading a catalog does not pay for them. '''
+    __slots__ = ('_args', '_tables', '_built')
+
+    def __init__(self, formula, lo: float, hi: float, charge: bool) -> None:
+        self._args = (formula, lo, hi, charge)
+        self._tables = None
+        self._built = False
+
+    def __iter__(self):
+        if not self._built:
+            self._tables = _energy_tables(*self._args)
+            self._built = True
+        return iter(self._tables) # None when the tables cannot be built, as _energy_tables
+
+def _tabulate(formula, lo: float, hi: float, points: int, max_error: float):
+    ''' Returns a CurveTable of formula over [lo, hi], or formula itself if it does not depend on SoC '''
+    probe = formula(np.array([lo, hi]))
+    if probe is None or np.ndim(probe) == 0: # empty or constant formula, nothing to interpolate
+        return formula
+    return CurveTable(formula, lo, hi, points if points is not None else LUT_POINTS, max_error)
+
+CATALOG_CACHE_VERSION = 3 # bump when the cached layout or the formula compiler changes
+
+def load_device_catalog(filename, lut_points: int = None, lut_max_error: float = None, cache: bool = False) -> tuple:
+    ''' Returns (device_data, device_specs) for a storage device behavior data file.
+        With cache, the parsed rows, the folded formula sources and the idle tables are kept in a
+        <filename>.cache file next to the data, keyed by the content hash of the CSV, so later loads
+        (e.g. in every worker process of a sweep) skip parsing, folding and integrating. The cache only
+        holds data (JSON and plain arrays); the cached sources are checked against the formula grammar
+        and compiled as they are. '''
+    with open(filename, 'rb') as devices_file:
+        raw = devices_file.read()
+    key = [CATALOG_CACHE_VERSION, hashlib.sha256(raw).hexdigest()]
+    cache_path = str(filename) + '.cache'
+    entry = _read_catalog_cache(cache_path, key) if cache else None
+    if entry is not None:
+        device_data, sources, idle = entry['rows'], entry['sources'], entry['idle']
+    else:
+        device_data = _parse_device_data(io.StringIO(raw.decode('utf-8-sig'), newline=''))
+        sources = {device: _fold_row(device_data[device], device) for device in device_data}
+        idle = None
+    compiled = {device: {name: _compile_source(source) for name, source in formulas.items()}
+                for device, formulas in sources.items()}
+    if idle is None:
+        idle = {device: _idle_table(compiled[device]['self_discharge'],
+                                    float(device_data[device]['min_charge']), float(device_data[device]['max_charge']))
+                for device in device_data}
+        if cache:
+            _write_catalog_cache(cache_path, {'key': key, 'rows': device_data, 'sources': sources, 'idle': idle})
+    device_specs = {device: DeviceSpec.from_row(device_data[device], device, lut_points, lut_max_error,
+                                                compiled[device], idle[device])
+                    for device in device_data}
+    return device_data, device_specs
+
+def check_device_data(filename, devices: list = DEFAULT_DEVICES) -> None:
+    ''' Checks a storage device data file against the columns DeviceSpec reads, without compiling anything.
+        Raises KeyError for a missing column or device type and ValueError when one of devices has an empty
+        formula or SoC bound. '''
+    device_data = load_device_data(filename)
+    for device in devices:
+        if device not in device_data:
+            raise KeyError(f"{filename} has no {device} row, it has {list(device_data)}")
+        row = device_data[device]
+        for name in REQUIRED_COLUMNS:
+            if name not in row:
+                raise KeyError(f"{filename} has no {name} column")
+            if name in NONEMPTY_COLUMNS and not (row[name] or '').strip():
+                raise ValueError(f"{filename} has no {name} for {device}")
+
+def _fold_row(row: dict, device: str) -> dict:
+    ''' fold_expr of the formulas of a parsed CSV row, a formula outside the grammar is a ValueError '''
+    sources = {}
+    for name in SPEC_FORMULAS:
+        try:
+            sources[name] = fold_expr(row[name])
+        except (SyntaxError, TypeError) as error:
+            raise ValueError(f"{device} {name} is not a formula of x and y: {row[name]!r}") from error
+    return sources
+
+def _read_catalog_cache(cache_path: str, key: list) -> dict:
+    ''' Returns the cache entry written by _write_catalog_cache, or None if it is missing, unreadable or stale '''
+    try:
+        with np.load(cache_path, allow_pickle=False) as arrays: # an .npz archive, never unpickled
+            header = json.loads(str(arrays['header']))
+            if not isinstance(header, dict) or header.get('key') != key:
+                return None
+            idle = {}
+            for device, rate in header['idle_rate'].items():
+                table = (arrays[f'{device}/steps'], arrays[f'{device}/soc']) if f'{device}/steps' in arrays else None
+                idle[device] = (rate, table)
+            for formulas in header['sources'].values():
+                for source in formulas.values():
+                    _check_source(source)
+    except (OSError, EOFError, KeyError, ValueError, TypeError, AttributeError, SyntaxError):
+        return None
+    return {'rows': header['rows'], 'sources': header['sources'], 'idle': idle}
+
+def _write_catalog_cache(cache_path: str, entry: dict) -> None:
+    header = {'key': entry['key'], 'rows': entry['rows'], 'sources': entry['sources'],
+              'idle_rate': {device: rate for device, (rate, _) in entry['idle'].items()}}
+    arrays = {'header': np.array(json.dumps(header))}
+    for device, (_, table) in entry['idle'].items():
+        if table is not None:
+            arrays[f'{device}/steps'], arrays[f'{device}/soc'] = table
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp" # other processes may be reading or writing the same cache
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(tmp_path, cache_path)
+    except OSError: # read-only data folder, the catalog is simply not cached
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
 
-        return li_battery, flow_battery, flywheel
 
 class Storage:
     '''
     StorageSuite
         Parameters
         ----------
-            - data: dict, parsed storage device behavior data; is different for each type
+            - data: DeviceSpec, shared device description; a parsed CSV row dict is compiled into one
             - type: str, desired storage device type
             - cap: float, desired storage device capacity in Wh
+            - name: str, optional, instance name in a StorageSuite, defaults to type
+            - lut_points: int, optional, evaluate the SoC formulas over arrays from a CurveTable sampled on this many points
+            - lut_max_error: float, optional, maximum interpolation error of the CurveTable (turns the LUT mode on)
         
         Attributes
         ----------
-            - self.DATA: constant dict, container for storage device behavior data
+            - self.spec: DeviceSpec, shared and immutable device description
+            - self.DATA: constant dict, container for storage device behavior data (read from self.spec)
             - self.TYPE: constant str, container for storage device type
+            - self.name: str, instance name, key of the device in StorageSuite dicts
             - self.cap: float, containter for storage device capacity in Wh
             - self.power: float, containter for storage device max  continuous power
             - self.MAX_SOC: constant float, container for maximum state of charge as a proportion of capacity
             - self.MIN_SOC: constant float, container for minimum state of charge as a proportion of capacity
             - self.min_energy: float = container for minimum energy in device
+            - self.soc: float, state of charge as a proportion of capacity
+            - self.soc_cap, self.capa_to_charge, self.capa_to_discharge: float, stored energy and energy left to charge/discharge
+              in Wh, computed on read and cached until soc or cap changes
             - self.FORMULA_PEAK_DISCHARGE: constant str, containter for max peak discharge formula
             - self.FORMULA_EFF_CHARGE: constant str, containter for charge efficiency formula
             - self.FORMULA_EFF_DISCHARGE: constant str, containter for discharge efficiency formula
             - self.FORMULA_SELF_DISCHARGE: constant str, containter for self-dsicharge formula
             - self.FORMULA_CAPITAL COST: constant str, containter for device capital cost formula based on desired capacity
+            - self._f_*: callables f(x), the SoC formulas of self.spec, kept in slots for the per-step path
 
     '''
-    def __init__(self, data: dict, type: str, cap=1) -> None: # 100 and 10 placeholder for testing
-        
+    __slots__ = ('spec', 'TYPE', 'name', 'power', 'MAX_SOC', 'MIN_SOC', 'min_energy', 'capital_cost', 'peak_discharge',
+                 'MARGINAL_COST', 'resp_time', 'RESP_SECONDS', '_soc', '_cap', '_derived', 'INIT_PEAK_TIME', 'peak_time',
+                 'engaged', 'rainflow', 'sensitivity', '_f_eff_charge', '_f_eff_discharge', '_f_self_discharge')
+
+    def __init__(self, data, type: str, cap=1, lut_points: int = None, lut_max_error: float = None, name: str = None) -> None: # 100 and 10 placeholder for testing
+        if not isinstance(data, DeviceSpec):
+            data = DeviceSpec.from_row(data, type, lut_points, lut_max_error)
         #fixed
-        self.DATA = data # CSV data dictionary
+        self.spec = data # shared device description
         self.TYPE = type # string representing the type of device
-        self.cap = cap # capacity, in Wh
-        self.power = eval_expr(str(data['max_cont_discharge'].replace("x", str(self.cap)))) # Returns in W
-        self.FORMULA_POWER = str(data['max_cont_discharge'].replace("x", "self.cap"))
-        """
-        self.START_WINDOW = data['start_window'] # start time that device can be used (V2G), in seconds of the day out of 86,400
-        self.END_WINDOW = data['end'] # end time that device can be used (V2G), in seconds of the day out of 86,400
-        """
-        self.MAX_SOC = float(data['max_charge']) # maximum charge as a proportion of capacity
-        self.MIN_SOC = float(data['min_charge']) # minimum charge as a proportion of capacity
-        self.cap  # * data['max_charge']  #maximum charge in kWh
-        self.min_energy = self.MIN_SOC * self.cap        # * data['min_charge']  #minimum charge in kWh
-        #self.MAX_CHARGE_RATE = ss.device_data['max_charge_rate']
-        #self.MIN_CHARGE_RATE = ss.device_data['min_charge_rate']
-        #self.MAX_CONT_DISCHARGE = ss.device_data['max_cont_discharge']
-        #self.MIN_DISCHARGE = ss.device_data['min_discharge'] * cap
-
-     
+        self.name = name if name is not None else type # key of the device in StorageSuite dicts
+        self.MAX_SOC = data.MAX_SOC # maximum charge as a proportion of capacity
+        self.MIN_SOC = data.MIN_SOC # minimum charge as a proportion of capacity
+        self._f_eff_charge = data.f_eff_charge
+        self._f_eff_discharge = data.f_eff_discharge
+        self._f_self_discharge = data.f_self_discharge
+        self.MARGINAL_COST = data.MARGINAL_COST # cost to use device per kWh in/out, in USD
+        self.resp_time = data.resp_time # time it takes for device to realize command, in seconds
+        self.RESP_SECONDS = data.RESP_SECONDS
+        self.INIT_PEAK_TIME = data.INIT_PEAK_TIME
+        self.rainflow = None # RainflowCounter once track_cycles is called
+        self.sensitivity = None # CapSensitivity once track_sensitivity is called
         #calculated
-        self.FORMULA_PEAK_DISCHARGE = data['max_peak_discharge'].replace("x", "self.cap").replace("y", "self.power") # in W
-        self.FORMULA_EFF_CHARGE = data['eff_charge'].replace("x", "self.soc")
-        self.FORMULA_EFF_DISCHARGE = data['eff_discharge'].replace("x", "self.soc").replace("'", "")
-        self.FORMULA_SELF_DISCHARGE = data['self_discharge'].replace("x", "self.soc").replace("'", "") # where x is SoC
-        self.FORMULA_CAPITAL_COST = data['capital_cost']
-        def _peak_discharge(self):
-            return eval_expr(self.FORMULA_PEAK_DISCHARGE.replace("self.cap", str(self.cap)).replace("self.power", str(self.power))) # assumed 10s peak capability, in W
-        def _capital_cost(self): # independent capacity and power capital cost formula
-            return eval_expr(self.FORMULA_CAPITAL_COST.replace("x", str(self.cap/1000)).replace("y", str(self.power/1000)).replace("'", ""))
-        self.capital_cost: float = _capital_cost(self)
-        self.peak_discharge = _peak_discharge(self) # In W
-        
-        self.MARGINAL_COST = data['marginal_cost'] # cost to use device per kWh in/out, in USD
-        self.resp_time = data['resp_time'] # time it takes for device to realize command, in seconds
+        self.resize(cap, reset_state=True)
+
+    def resize(self, cap: float, reset_state: bool = False) -> None:
+        ''' Changes the capacity in place, recomputing only the capacity dependent quantities.
+            The SoC and peak_time are kept unless reset_state is True. '''
+        spec = self.spec
+        self.cap = cap # capacity, in Wh
+        self.power = spec.f_power(cap) # Returns in W
+        self.min_energy = self.MIN_SOC * cap # minimum charge in Wh
+        self.capital_cost: float = spec.f_capital_cost(cap/1000, self.power/1000 if self.power is not None else None) # independent capacity and power capital cost formula
+        self.peak_discharge = spec.f_peak_discharge(cap, self.power) # assumed 10s peak capability, in W
+        if reset_state:
+            self.reset_state()
+
+    def reset_state(self) -> None:
+        ''' Puts the device back in its initial state: full and with all of its peak time available '''
         self.soc = 1 # state of charge as a proportion of capacity
-        self.soc_cap = self.soc * self.cap # state of charge in kWh
-        self.INIT_PEAK_TIME = data['peak_time']
-        self.peak_time = int(self.INIT_PEAK_TIME) #how many consecutive seconds the device can still peak for
-        self.capa_to_charge = self.cap * (1-self.soc)
-        self.capa_to_discharge = self.cap * self.soc
+        self.peak_time = self.INIT_PEAK_TIME #how many consecutive seconds the device can still peak for
+        self.engaged = 0 # direction of the last interval command, 1 charging, -1 discharging, 0 idle
+        if self.rainflow is not None: # a new life for the device
+            self.track_cycles(self.rainflow.bins)
+        if self.sensitivity is not None:
+            self.track_sensitivity()
+
+    def fork(self) -> 'Storage':
+        ''' Returns a copy of the device in its current state sharing the DeviceSpec, to branch a simulation.
+            The cycle and sensitivity trackers are copied. '''
+        clone = Storage.__new__(Storage)
+        for slot in Storage.__slots__:
+            setattr(clone, slot, getattr(self, slot))
+        if self.rainflow is not None:
+            clone.rainflow = copy.deepcopy(self.rainflow)
+        if self.sensitivity is not None:
+            clone.sensitivity = copy.copy(self.sensitivity)
+        return clone
+
+    def save_state(self) -> tuple:
+        ''' Returns the dynamic state of the device, (soc, peak_time, engaged, rainflow, sensitivity), to be put
+            back by restore_state. The cycle and sensitivity trackers are copies, None when not tracking. '''
+        rainflow = copy.deepcopy(self.rainflow) if self.rainflow is not None else None
+        sensitivity = copy.copy(self.sensitivity) if self.sensitivity is not None else None
+        return self._soc, self.peak_time, self.engaged, rainflow, sensitivity
+
+    def restore_state(self, state: tuple) -> None:
+        ''' Puts back a state returned by save_state, trackers included, and can do so again. The sizing is kept;
+            a tracker started after save_state starts over from the restored state. '''
+        self._soc, self.peak_time, self.engaged, rainflow, sensitivity = state
+        self._derived = None
+        if rainflow is not None:
+            self.rainflow = copy.deepcopy(rainflow)
+        elif self.rainflow is not None:
+            self.track_cycles(self.rainflow.bins)
+        if sensitivity is not None:
+            self.sensitivity = copy.copy(sensitivity)
+        elif self.sensitivity is not None:
+            self.track_sensitivity()
+
+    def track_cycles(self, bins: int = CYCLE_BINS) -> 'RainflowCounter':
+        ''' Starts counting charge/discharge cycles from the current SoC, see RainflowCounter '''
+        self.rainflow = RainflowCounter(bins)
+        self.rainflow.update(self.soc)
+        return self.rainflow
+
+    def track_sensitivity(self) -> 'CapSensitivity':
+        ''' Starts propagating the derivatives of the state and energy flows with respect to cap, see CapSensitivity '''
+        self.sensitivity = CapSensitivity()
+        return self.sensitivity
+
+    @property
+    def soc(self) -> float: # state of charge as a proportion of capacity
+        return self._soc
+
+    @soc.setter
+    def soc(self, soc: float) -> None:
+        self._soc = soc
+        self._derived = None
+
+    @property
+    def cap(self) -> float: # capacity, in Wh
+        return self._cap
+
+    @cap.setter
+    def cap(self, cap: float) -> None:
+        self._cap = cap
+        self._derived = None
+
+    def _derive(self) -> tuple:
+        ''' Recomputes (soc_cap, capa_to_charge, capa_to_discharge), only on the first read after soc or cap changed '''
+        soc, cap = self._soc, self._cap
+        self._derived = (cap * soc, cap * (self.MAX_SOC - soc), cap * (soc - self.MIN_SOC))
+        return self._derived
+
+    @property
+    def soc_cap(self) -> float: # state of charge in Wh
+        return (self._derived or self._derive())[0]
+
+    @property
+    def capa_to_charge(self) -> float: # energy that can still be stored before MAX_SOC, in Wh
+        return (self._derived or self._derive())[1]
+
+    @property
+    def capa_to_discharge(self) -> float: # energy that can still be removed before MIN_SOC, in Wh
+        return (self._derived or self._derive())[2]
+
+    @property
+    def DATA(self) -> Mapping:
+        return self.spec.DATA # CSV data dictionary, shared by all devices of this type
+
+    @property
+    def FORMULA_POWER(self) -> str:
+        return str(self.DATA['max_cont_discharge'].replace("x", "self.cap"))
+
+    @property
+    def FORMULA_PEAK_DISCHARGE(self) -> str:
+        return self.DATA['max_peak_discharge'].replace("x", "self.cap").replace("y", "self.power") # in W
+
+    @property
+    def FORMULA_EFF_CHARGE(self) -> str:
+        return self.DATA['eff_charge'].replace("x", "self.soc")
+
+    @property
+    def FORMULA_EFF_DISCHARGE(self) -> str:
+        return self.DATA['eff_discharge'].replace("x", "self.soc").replace("'", "")
+
+    @property
+    def FORMULA_SELF_DISCHARGE(self) -> str:
+        return self.DATA['self_discharge'].replace("x", "self.soc").replace("'", "") # where x is SoC
+
+    @property
+    def FORMULA_CAPITAL_COST(self) -> str:
+        return self.DATA['capital_cost']
 
     def _get_self_discharge_rate(self) -> float: # self-discharge rate, in SOC/s
-        self.soc_cap = self.cap * self.soc
-        return eval_expr(self.FORMULA_SELF_DISCHARGE.replace("self.soc", str(self.soc)).replace("e", str(e)))
-        # parsed_expr = ast.parse(self.FORMULA_SELF_DISCHARGE.replace("self.soc", str(self.soc)).replace("e", str(e)))
-        # return ast.literal_eval(parsed_expr)
+        return self._f_self_discharge(self._soc)
     def _eff_charge(self) -> float: # charge effiency function
-        self.soc_cap = self.cap * self.soc
-        return eval_expr(self.FORMULA_EFF_CHARGE.replace("self.soc", str(self.soc)).replace("'", ""))
+        return self._f_eff_charge(self._soc)
 
     def _eff_discharge(self) -> float: # discharge effiency function
-        self.soc_cap = self.cap * self.soc
-        return eval_expr(self.FORMULA_EFF_DISCHARGE.replace("self.soc", str(self.soc)))
+        return self._f_eff_discharge(self._soc)
+
+    def evaluate_curves(self, soc) -> dict:
+        ''' Evaluates eff_charge, eff_discharge and self_discharge over a NumPy array of SoC values in one call '''
+        soc, spec = np.asarray(soc, dtype=float), self.spec
+        return {'eff_charge': _curve(spec.array_eff_charge, soc),
+                'eff_discharge': _curve(spec.array_eff_discharge, soc),
+                'self_discharge': _curve(spec.array_self_discharge, soc)}
+
+    def charge_headroom(self) -> float:
+        ''' Grid side energy that charges the device from its SoC to MAX_SOC, with the efficiency along the way '''
+        to_energy, _ = self.spec.charge_energy
+        return self.cap * (to_energy(self.MAX_SOC) - to_energy(self.soc))
+
+    def discharge_headroom(self) -> float:
+        ''' Grid side energy the device delivers from its SoC down to MIN_SOC, with the efficiency along the way '''
+        to_energy, _ = self.spec.discharge_energy
+        return self.cap * to_energy(self.soc)
+
+    def soc_after_charge(self, power_used: float) -> float:
+        ''' SoC reached by charging power_used from the grid (capped at MAX_SOC), without changing the device '''
+        to_energy, to_soc = self.spec.charge_energy
+        return to_soc(to_energy(self.soc) + power_used / self.cap)
+
+    def soc_after_discharge(self, power_requested: float) -> float:
+        ''' SoC reached by delivering power_requested to the grid (floored at MIN_SOC), without changing the device '''
+        to_energy, to_soc = self.spec.discharge_energy
+        return to_soc(to_energy(self.soc) - power_requested / self.cap)
 
     def _current_charge(self) -> float:
         return self.soc * self.cap
     
     def _self_discharge(self) -> float:
-        delta_soc = self._get_self_discharge_rate()/1000 # In %
-        if (self.soc - delta_soc) < self.MIN_SOC:
+        soc = self._soc
+        delta_soc = self._f_self_discharge(soc)/1000 # In %
+        empty = (soc - delta_soc) < self.MIN_SOC
+        if empty:
+            delta_soc = soc - self.MIN_SOC # only down to the minimum charge
+            self._soc = self.MIN_SOC
+        else:
+            self._soc = soc - delta_soc
+        self._derived = None
+        if self.sensitivity is not None:
+            self.sensitivity.self_discharge(self, soc, delta_soc, empty)
+
+        return (delta_soc * self._cap) # Energy Lost in Wh
+
+    def fast_forward_idle(self, n_steps: int) -> float:
+        ''' Advances the device over n_steps idle steps in one call, like n_steps calls of _self_discharge.
+            Constant rates are applied in closed form, SoC dependent ones from the integrated self-discharge
+            ODE of the device spec (see _idle_table and _idle_forward); short stretches and rates that can reach
+            zero are stepped. Returns the energy lost in Wh.
+            Against n_steps calls of _self_discharge, the energy lost is within a relative (h * f'/f)**2 / 8,
+            h = (MAX_SOC - MIN_SOC) / (IDLE_POINTS - 1), plus the third order of the steps: 3e-6 for the v6
+            li-ion (f'/f = 21.3, the steepest near SoC 1) and 3e-9 for the v6 flywheel, from any SoC. '''
+        if n_steps <= 0:
+            return 0.0
+        soc = self.soc
+        idle_rate, idle_table = self.spec.idle_rate, self.spec.idle_table
+        if idle_rate is not None: # constant rate
+            new_soc = soc - n_steps * idle_rate
+        elif idle_table is not None and n_steps > IDLE_STEP_LIMIT and self.MIN_SOC <= soc <= self.MAX_SOC:
+            new_soc = _idle_forward(self._f_self_discharge, idle_table, soc, n_steps)
+            if new_soc is None:
+                new_soc = self.MIN_SOC
+        else:
+            rate = self._f_self_discharge
+            new_soc = soc
+            for _ in range(n_steps):
+                new_soc -= rate(new_soc)/1000
+                if new_soc < self.MIN_SOC:
+                    break
+        if new_soc < self.MIN_SOC: # only down to the minimum charge
+            new_soc = self.MIN_SOC
+        self.soc = new_soc
+        return (soc - new_soc) * self.cap # Energy Lost in Wh
+
+    def apply_schedule(self, power, inplace: bool = False) -> dict:
+        ''' Runs a whole signed schedule through the _charge/_discharge rules in one tight loop.
+            power[t] > 0 is the grid energy used to charge (power_used), power[t] < 0 the energy
+            requested from the device (power_requested). Returns arrays over the schedule of the
+            grid side energy (positive in), the device side energy (positive stored), the soc and
+            peak_time after each step and the marginal cost. The device is left as it was unless inplace. '''
+        power = np.asarray(power, dtype=float).tolist()
+        n_steps = len(power)
+        grid_side, device_side = [0.0] * n_steps, [0.0] * n_steps
+        soc_out, peak_time_out = [0.0] * n_steps, [0] * n_steps
+        eff_charge, eff_discharge = self._f_eff_charge, self._f_eff_discharge
+        cap, rated_power, peak_discharge = self.cap, self.power, self.peak_discharge
+        max_soc, min_soc, max_energy, min_energy = self.MAX_SOC, self.MIN_SOC, self.MAX_SOC * self.cap, self.min_energy
+        init_peak_time = self.INIT_PEAK_TIME
+        soc, peak_time = self.soc, self.peak_time
+        for t, value in enumerate(power):
+            if value > 0: # same steps as _charge
+                soc_cap = cap * soc
+                power_stored = eff_charge(soc) * value
+                if (soc_cap + power_stored) > max_energy: # Charge to full
+                    value = max_energy - soc_cap
+                    power_stored = value
+                    soc = max_soc
+                else:
+                    soc = (soc_cap + power_stored) / cap
+                grid_side[t], device_side[t] = value, power_stored
+            elif value < 0 and soc != min_soc: # same steps as _discharge
+                power_requested = -value
+                soc_cap = cap * soc
+                power_spent = power_requested / eff_discharge(soc)
+                if power_requested > peak_discharge:
+                    raise ValueError(f"Power requested at step {t} is above max peak. max peak: {peak_discharge} W, received: {power_requested} W. Delta = {power_requested - peak_discharge} W")
+                if (soc_cap - power_spent) < min_energy: # Discharge down to the minimum charge
+                    power_spent = soc_cap - min_energy
+                    power_requested = power_spent
+                    soc = min_soc
+                else:
+                    soc = (soc_cap - power_spent) / cap
+                if power_requested > rated_power:
+                    peak_time -= 1
+                elif peak_time != init_peak_time:
+                    peak_time += 1
+                grid_side[t], device_side[t] = -power_requested, -power_spent
+            soc_out[t], peak_time_out[t] = soc, peak_time
+        if inplace:
+            self.soc = soc
+            self.peak_time = peak_time
+            if self.rainflow is not None:
+                for value, soc in zip(power, soc_out):
+                    if value != 0:
+                        self.rainflow.update(soc)
+        grid_side = np.array(grid_side)
+        return {'grid': grid_side,
+                'device': np.array(device_side),
+                'soc': np.array(soc_out),
+                'peak_time': np.array(peak_time_out),
+                'marginal_cost': self.MARGINAL_COST * np.abs(grid_side)}
+
+    def charge_interval(self, power_used: float, dt: float, econ_cost = None) -> tuple:
+        ''' Charges at power_used W for dt seconds in one call of _charge with the energy of the interval.
+            A device that was not charging in its last interval only starts after RESP_SECONDS.
+            A zero power_used leaves the device idle. Returns (used, stored) over the interval, in Wh. '''
+        if power_used <= 0 or dt <= 0:
+            self.engaged = 0
+            return 0.0, 0.0
+        delay = min(self.RESP_SECONDS, dt) if self.engaged != 1 else 0.0
+        self.engaged = 1
+        return self._charge(econ_cost, power_used=power_used * (dt - delay) / HOUR_SECONDS)
+
+    def discharge_interval(self, power_requested: float, dt: float, econ_cost = None) -> tuple:
+        ''' Discharges at power_requested W for dt seconds in one call, resolving the peak dynamics of the
+            seconds of a long step analytically instead of looping over them.
+            Above the rated power the request is met while peak_time lasts and the rest of the interval
+            runs at the rated power; at or below it, every second of use gives one peak second back.
+            A device that was not discharging in its last interval only starts after RESP_SECONDS.
+            A zero power_requested leaves the device idle. Returns (requested, spent) over the interval, in Wh. '''
+        if power_requested <= 0 or dt <= 0:
+            self.engaged = 0
+            return 0.0, 0.0
+        if power_requested > self.peak_discharge:
+            raise ValueError(f"Power requested is above max peak. max peak: {self.peak_discharge} W, received: {power_requested} W. Delta = {power_requested - self.peak_discharge} W")
+        delay = min(self.RESP_SECONDS, dt) if self.engaged != -1 else 0.0
+        self.engaged = -1
+        soc = self._soc
+        if soc == self.MIN_SOC:
+            return 0.0, 0.0
+        run_time = dt - delay
+        eff = self._eff_discharge()
+        peaking = power_requested > self.power
+        if peaking: # peak first, then the rated power
+            peak_time = min(max(self.peak_time, 0), run_time)
+            rate = self.power
+        else:
+            peak_time = 0
+            rate = power_requested
+        peak_spent = power_requested * peak_time / HOUR_SECONDS / eff # energies in Wh
+        power_requested = (power_requested * peak_time + rate * (run_time - peak_time)) / HOUR_SECONDS
+        power_spent = power_requested / eff
+        soc_cap = self.soc_cap
+        empty = (soc_cap - power_spent) < self.min_energy
+        if empty: # empties during the interval
+            power_spent = soc_cap - self.min_energy # Discharge down to the minimum charge
+            if power_spent < peak_spent:
+                peak_time = peak_time * power_spent / peak_spent
+                run_time = peak_time
+            else:
+                run_time = peak_time + (power_spent - peak_spent) * eff / rate * HOUR_SECONDS
+            power_requested = power_spent
             self.soc = self.MIN_SOC
-            delta_soc = self.MIN_SOC
-            self.soc_cap = self.min_energy
         else:
-            self.soc -= delta_soc
-            self.soc_cap = self.cap * self.soc
+            self.soc = (soc_cap - power_spent) / self._cap
+        if self.sensitivity is not None: # the energy of the interval is fixed by the command, as in _discharge
+            self.sensitivity.discharge(self, soc, power_spent, empty, False)
 
-        return (delta_soc * self.cap) # Energy Lost in Wh
+        if peaking:
+            self.peak_time -= peak_time
+        else:
+            self.peak_time = min(self.INIT_PEAK_TIME, self.peak_time + run_time)
+        if self.rainflow is not None:
+            self.rainflow.update(self.soc)
+        if econ_cost != None:
+            econ_cost.cost += self.MARGINAL_COST * power_requested
+        return power_requested, power_spent
 
     def _print_properties(self) -> None:
         print("**************************\n")
@@ -307,18 +1393,18 @@ class Storage:
             print(prop + ": " + self.DATA[prop] + "\n")
 
     def _get_properties(self, properties:dict) -> None:
-        properties[self.TYPE]['type']           = self.TYPE
-        properties[self.TYPE]['cap']            = self.cap
-        properties[self.TYPE]['max_cont_power'] = self.power
-        properties[self.TYPE]['max_soc']        = self.MAX_SOC
-        properties[self.TYPE]['min_soc']        = self.MIN_SOC
-        properties[self.TYPE]['max_energy']     = self.cap
-        properties[self.TYPE]['min_energy']     = self.min_energy
-        properties[self.TYPE]['max_peak_power'] = self.peak_discharge
-        properties[self.TYPE]['capital_cost']   = self.capital_cost
-        properties[self.TYPE]['marginal_cost']  = self.MARGINAL_COST
-        properties[self.TYPE]['resp_time']      = self.resp_time
-        properties[self.TYPE]['max_peak_time']  = self.INIT_PEAK_TIME
+        properties[self.name]['type']           = self.TYPE
+        properties[self.name]['cap']            = self.cap
+        properties[self.name]['max_cont_power'] = self.power
+        properties[self.name]['max_soc']        = self.MAX_SOC
+        properties[self.name]['min_soc']        = self.MIN_SOC
+        properties[self.name]['max_energy']     = self.cap
+        properties[self.name]['min_energy']     = self.min_energy
+        properties[self.name]['max_peak_power'] = self.peak_discharge
+        properties[self.name]['capital_cost']   = self.capital_cost
+        properties[self.name]['marginal_cost']  = self.MARGINAL_COST
+        properties[self.name]['resp_time']      = self.resp_time
+        properties[self.name]['max_peak_time']  = self.INIT_PEAK_TIME
 
     def _print_variables(self) -> None:
         print("**************************\n")
@@ -326,30 +1412,44 @@ class Storage:
         print("Capacity: " + self.cap + "kWh\n")
         print("Power: " + self.power + "kW\n")
 
+    def _state_row(self) -> tuple:
+        ''' Values of _get_state in STATUS_DTYPE field order '''
+        return (self.soc, self._current_charge(), self._eff_charge(), self._eff_discharge(),
+                self._get_self_discharge_rate(), self.peak_time)
+
     def _get_state(self, variables:dict) -> None:
-        variables[self.TYPE]['soc'] = self.soc
-        variables[self.TYPE]['stored_energy'] = self._current_charge()
-        variables[self.TYPE]['eff_charge'] = self._eff_charge()
-        variables[self.TYPE]['eff_discharge'] = self._eff_discharge()
-        variables[self.TYPE]['self_discharge'] = self._get_self_discharge_rate()
-        variables[self.TYPE]['peak_time_left'] = self.peak_time
+        variables[self.name]['soc'] = self.soc
+        variables[self.name]['stored_energy'] = self._current_charge()
+        variables[self.name]['eff_charge'] = self._eff_charge()
+        variables[self.name]['eff_discharge'] = self._eff_discharge()
+        variables[self.name]['self_discharge'] = self._get_self_discharge_rate()
+        variables[self.name]['peak_time_left'] = self.peak_time
 
     def _charge(self, econ_cost = None, power_used: float = None, power_stored: float = None) -> float:
         """ Returns both the energy used by the grid to charge the battery and the amount of energy actually stored by the battery in 1 second.
             power_used < power_stored """
-        
+        cap = self._cap # the per-step methods use the slots and clear _derived themselves, like the soc setter
+        soc = self._soc
+        soc_cap = cap * soc
+        from_stored = power_stored != None
         if power_stored == None:
             power_stored = self._eff_charge() * power_used
         elif power_used == None:
             power_used = power_stored / self._eff_charge()
-        if (self.soc_cap + power_stored) > self.MAX_SOC:
-            self.soc = self.MAX_SOC # Charge to full
-            power_used = self.cap - self.soc_cap # in Wh
+        max_energy = self.MAX_SOC * cap
+        full = (soc_cap + power_stored) > max_energy
+        if full:
+            power_used = max_energy - soc_cap # Charge to full, in Wh
             power_stored = power_used
-
-        self.soc_cap += power_stored
-        self.soc = self.soc_cap / self.cap
+            self._soc = self.MAX_SOC
+        else:
+            self._soc = (soc_cap + power_stored) / cap
+        self._derived = None
         
+        if self.sensitivity is not None:
+            self.sensitivity.charge(self, soc, power_used, full, from_stored)
+        if self.rainflow is not None:
+            self.rainflow.update(self._soc)
         if econ_cost != None:
             econ_cost.cost += self.MARGINAL_COST * power_used
         return power_used, power_stored
@@ -357,8 +1457,12 @@ class Storage:
     def _discharge(self, econ_cost = None, power_requested: float = None, power_spent: float = None) -> float:
         """ Returns both the power requested by the grid and the actual amount pulled by the battery in 1 second.
             power_requested < power_spent """
-        if self.soc == self.MIN_SOC:
+        if self._soc == self.MIN_SOC:
             return 0,0
+        cap = self._cap
+        soc = self._soc
+        soc_cap = cap * soc
+        from_spent = power_requested == None
         if power_requested == None:
             power_requested = self._eff_discharge() * power_spent
         elif power_spent == None:
@@ -368,21 +1472,243 @@ class Storage:
         if power_requested > self.peak_discharge:
             raise ValueError(f"Power requested is above max peak. max peak: {self.peak_discharge} W, received: {power_requested} W. Delta = {power_requested - self.peak_discharge} W")
 
-        if (self.soc_cap - power_spent) < self.min_energy:
-            self.soc = self.MIN_SOC
-            power_spent = self.soc_cap
+        empty = (soc_cap - power_spent) < self.min_energy
+        if empty:
+            power_spent = soc_cap - self.min_energy # Discharge down to the minimum charge
             power_requested = power_spent
-   
-        self.soc_cap -= power_spent
-        self.soc = self.soc_cap / self.cap
-
-        if self.soc == 0:
-            self.soc = self.MIN_SOC
+            self._soc = self.MIN_SOC
+        else:
+            self._soc = (soc_cap - power_spent) / cap
+        self._derived = None
+        if self.sensitivity is not None:
+            self.sensitivity.discharge(self, soc, power_spent, empty, from_spent)
 
         if power_requested > self.power:
             self.peak_time -= 1
         elif self.peak_time != self.INIT_PEAK_TIME:
             self.peak_time += 1
+        if self.rainflow is not None:
+            self.rainflow.update(self._soc)
         if econ_cost != None:
             econ_cost.cost += self.MARGINAL_COST * power_requested
-        return power_requested, power_spent
\ No newline at end of file
+        return power_requested, power_spent
+
+
+class StorageBank:
+    ''' Struct-of-arrays version of Storage for fleet studies: N device types in M microgrids.
+        StorageSuite dispatches its devices through a bank with one row.
+        Every field is a contiguous (M, N) float64 array, column j holding device type types[j].
+        charge, discharge and self_discharge follow Storage._charge, Storage._discharge and
+        Storage._self_discharge element-wise, so one call steps all M x N devices.
+
+        Parameters
+        ----------
+            - device_data: dict, DeviceSpec or parsed CSV row per device type, as in StorageSuite.device_specs
+            - types: list, device type of each column
+            - caps: array of shape (M, N), device capacities in Wh
+
+        Attributes
+        ----------
+            - self.types: tuple, device type of each column
+            - self.cap, self.power, self.peak_discharge, self.min_energy, self.capital_cost: (M, N) arrays, sizing
+            - self.max_soc, self.min_soc, self.marginal_cost, self.init_peak_time, self.resp_seconds: (M, N) arrays, device constants
+            - self.soc, self.peak_time, self.engaged: (M, N) arrays, dynamic state
+    '''
+    def __init__(self, device_data: dict, types: list, caps) -> None:
+        self.types = tuple(types)
+        self.cap = np.array(caps, dtype=float, ndmin=2, order='C')
+        if self.cap.shape[1] != len(self.types):
+            raise ValueError(f"caps has {self.cap.shape[1]} columns for {len(self.types)} device types")
+        shape = self.cap.shape
+        self._f_eff_charge, self._f_eff_discharge, self._f_self_discharge = [], [], []
+        tables = shape[0] <= LUT_MAX_ROWS # the CurveTables of LUT mode, the formulas on more rows
+        self.power, self.peak_discharge, self.capital_cost = np.empty(shape), np.empty(shape), np.empty(shape)
+        self.max_soc, self.min_soc = np.empty(shape), np.empty(shape)
+        self.marginal_cost, self.init_peak_time = np.empty(shape), np.empty(shape)
+        self.resp_seconds = np.empty(shape)
+        for j, device in enumerate(self.types):
+            spec = device_data[device]
+            if not isinstance(spec, DeviceSpec):
+                spec = DeviceSpec.from_row(spec, device)
+            cap = self.cap[:, j]
+            self._f_eff_charge.append(spec.array_eff_charge if tables else spec.f_eff_charge)
+            self._f_eff_discharge.append(spec.array_eff_discharge if tables else spec.f_eff_discharge)
+            self._f_self_discharge.append(spec.array_self_discharge if tables else spec.f_self_discharge)
+            self.power[:, j] = spec.f_power(cap)
+            self.peak_discharge[:, j] = spec.f_peak_discharge(cap, self.power[:, j])
+            self.capital_cost[:, j] = spec.f_capital_cost(cap/1000, self.power[:, j]/1000)
+            self.max_soc[:, j] = spec.MAX_SOC
+            self.min_soc[:, j] = spec.MIN_SOC
+            self.marginal_cost[:, j] = spec.MARGINAL_COST
+            self.init_peak_time[:, j] = spec.INIT_PEAK_TIME
+            self.resp_seconds[:, j] = spec.RESP_SECONDS
+        self.min_energy = self.min_soc * self.cap
+        self.soc = np.ones(shape) # same initial state as Storage
+        self.peak_time = self.init_peak_time.copy()
+        self.engaged = np.zeros(shape)
+
+    @classmethod
+    def from_suites(cls, suites: list) -> 'StorageBank':
+        ''' Builds a bank with one row per StorageSuite, copying the sizing and current state of the devices '''
+        types = [device.TYPE for device in suites[0].devices]
+        bank = cls(suites[0].device_specs, types, [[device.cap for device in ss.devices] for ss in suites])
+        for i, ss in enumerate(suites):
+            for j, device in enumerate(ss.devices):
+                bank.power[i, j] = device.power
+                bank.peak_discharge[i, j] = device.peak_discharge
+                bank.min_energy[i, j] = device.min_energy
+                bank.capital_cost[i, j] = device.capital_cost
+                bank.soc[i, j] = device.soc
+                bank.peak_time[i, j] = device.peak_time
+                bank.engaged[i, j] = device.engaged
+        return bank
+
+    def _by_column(self, formulas: list) -> np.ndarray:
+        ''' Evaluates one SoC formula per column over all rows '''
+        out = np.empty(self.soc.shape)
+        for j, formula in enumerate(formulas):
+            out[:, j] = formula(self.soc[:, j])
+        return out
+
+    def eff_charge(self) -> np.ndarray:
+        return self._by_column(self._f_eff_charge)
+
+    def eff_discharge(self) -> np.ndarray:
+        return self._by_column(self._f_eff_discharge)
+
+    def self_discharge_rate(self) -> np.ndarray:
+        return self._by_column(self._f_self_discharge)
+
+    def stored_energy(self) -> np.ndarray:
+        return self.soc * self.cap
+
+    def charge(self, power_used=None, power_stored=None) -> tuple:
+        ''' Vectorized Storage._charge, returns the (power_used, power_stored) arrays actually applied
+            Entries with nothing to charge are left untouched, like a device that is not called. '''
+        soc_cap = self.soc * self.cap
+        if power_stored is None:
+            power_used = np.broadcast_to(np.asarray(power_used, dtype=float), self.soc.shape)
+            power_stored = self.eff_charge() * power_used
+        else:
+            power_stored = np.broadcast_to(np.asarray(power_stored, dtype=float), self.soc.shape)
+            power_used = power_stored / self.eff_charge()
+        active = (power_used > 0) | (power_stored > 0)
+        max_energy = self.max_soc * self.cap
+        full = active & ((soc_cap + power_stored) > max_energy) # Charge to full
+        power_used = np.where(active, np.where(full, max_energy - soc_cap, power_used), 0.0)
+        power_stored = np.where(full, power_used, np.where(active, power_stored, 0.0))
+        self.soc = np.where(full, self.max_soc, np.where(active, (soc_cap + power_stored) / self.cap, self.soc))
+        return power_used, power_stored
+
+    def discharge(self, power_requested=None, power_spent=None) -> tuple:
+        ''' Vectorized Storage._discharge, returns the (power_requested, power_spent) arrays actually applied
+            Entries with nothing to discharge are left untouched, like a device that is not called. '''
+        soc_cap = self.soc * self.cap
+        if power_spent is None:
+            power_requested = np.broadcast_to(np.asarray(power_requested, dtype=float), self.soc.shape)
+            power_spent = power_requested / self.eff_discharge()
+        else:
+            power_spent = np.broadcast_to(np.asarray(power_spent, dtype=float), self.soc.shape)
+            power_requested = self.eff_discharge() * power_spent
+        active = (self.soc != self.min_soc) & ((power_requested > 0) | (power_spent > 0))
+        power_requested = np.where(active, power_requested, 0.0)
+        power_spent = np.where(active, power_spent, 0.0)
+
+        ###### Error Checking ######
+        over_peak = power_requested > self.peak_discharge
+        if over_peak.any():
+            idx = tuple(np.argwhere(over_peak)[0])
+            raise ValueError(f"Power requested is above max peak at {idx}. max peak: {self.peak_discharge[idx]} W, received: {power_requested[idx]} W")
+
+        empty = (soc_cap - power_spent) < self.min_energy # Discharge down to the minimum charge
+        power_spent = np.where(empty, soc_cap - self.min_energy, power_spent)
+        power_requested = np.where(empty, power_spent, power_requested)
+        self.soc = np.where(empty, self.min_soc, (soc_cap - power_spent) / self.cap)
+
+        peaking = active & (power_requested > self.power)
+        recovering = active & ~peaking & (self.peak_time != self.init_peak_time)
+        self.peak_time = self.peak_time - peaking + recovering
+        return power_requested, power_spent
+
+    def charge_interval(self, power_used, dt: float) -> tuple:
+        ''' Vectorized Storage.charge_interval, returns the (power_used, power_stored) arrays over the interval '''
+        power_used = np.broadcast_to(np.asarray(power_used, dtype=float), self.soc.shape)
+        active = (power_used > 0) & (dt > 0)
+        delay = np.where(active & (self.engaged != 1), np.minimum(self.resp_seconds, dt), 0.0)
+        self.engaged = np.where(active, 1.0, 0.0)
+        return self.charge(power_used=np.where(active, power_used * (dt - delay) / HOUR_SECONDS, 0.0))
+
+    def discharge_interval(self, power_requested, dt: float) -> tuple:
+        ''' Vectorized Storage.discharge_interval, returns the (power_requested, power_spent) arrays over the interval '''
+        power = np.broadcast_to(np.asarray(power_requested, dtype=float), self.soc.shape)
+        commanded = (power > 0) & (dt > 0)
+        power = np.where(commanded, power, 0.0)
+
+        ###### Error Checking ######
+        over_peak = power > self.peak_discharge
+        if over_peak.any():
+            idx = tuple(np.argwhere(over_peak)[0])
+            raise ValueError(f"Power requested is above max peak at {idx}. max peak: {self.peak_discharge[idx]} W, received: {power[idx]} W")
+
+        delay = np.where(commanded & (self.engaged != -1), np.minimum(self.resp_seconds, dt), 0.0)
+        self.engaged = np.where(commanded, -1.0, 0.0)
+        active = commanded & (self.soc != self.min_soc)
+        run_time = np.where(active, dt - delay, 0.0)
+        soc_cap = self.soc * self.cap
+        eff = self.eff_discharge()
+        peaking = active & (power > self.power)
+        peak_time = np.where(peaking, np.clip(self.peak_time, 0, run_time), 0.0) # peak first, then the rated power
+        rate = np.where(peaking, self.power, power)
+        peak_spent = power * peak_time / HOUR_SECONDS / eff # energies in Wh
+        power_requested = (power * peak_time + rate * (run_time - peak_time)) / HOUR_SECONDS
+        power_spent = power_requested / eff
+
+        empty = active & ((soc_cap - power_spent) < self.min_energy) # empties during the interval
+        with np.errstate(divide='ignore', invalid='ignore'):
+            left = soc_cap - self.min_energy
+            in_peak = empty & (left < peak_spent)
+            peak_time = np.where(in_peak, peak_time * left / peak_spent, peak_time)
+            run_time = np.where(in_peak, peak_time,
+                                np.where(empty, peak_time + (left - peak_spent) * eff / rate * HOUR_SECONDS, run_time))
+        power_spent = np.where(empty, left, power_spent)
+        power_requested = np.where(empty, power_spent, power_requested)
+        self.soc = np.where(empty, self.min_soc, np.where(active, (soc_cap - power_spent) / self.cap, self.soc))
+
+        recovered = np.minimum(self.init_peak_time, self.peak_time + run_time)
+        self.peak_time = np.where(peaking, self.peak_time - peak_time, np.where(active, recovered, self.peak_time))
+        return power_requested, power_spent
+
+    def dispatch(self, power) -> tuple:
+        ''' Charges (power > 0) or discharges (power < 0) every device for one step, the others are not called.
+            Returns the grid side (positive in) and device side (positive stored) energy arrays. '''
+        power = np.broadcast_to(np.asarray(power, dtype=float), self.soc.shape)
+        used, stored = self.charge(power_used=np.where(power > 0, power, 0.0))
+        requested, spent = self.discharge(power_requested=np.where(power < 0, -power, 0.0))
+        return used - requested, stored - spent
+
+    def dispatch_interval(self, power, dt: float) -> tuple:
+        ''' Charges (power > 0) or discharges (power < 0) every device at power W for dt seconds, see
+            charge_interval and discharge_interval; the others are idle. Returns the grid side (positive in) and device side (positive
+            stored) energy arrays over the interval, in Wh. '''
+        power = np.broadcast_to(np.asarray(power, dtype=float), self.soc.shape)
+        charging, discharging = power > 0, power < 0
+        used = stored = requested = spent = 0.0 # each half only runs when some device has something to do
+        engaged = self.engaged
+        if charging.any():
+            used, stored = self.charge_interval(np.where(charging, power, 0.0), dt)
+            self.engaged = engaged # discharge_interval sets it again, a discharging device keeps its direction
+        if discharging.any():
+            requested, spent = self.discharge_interval(np.where(discharging, -power, 0.0), dt)
+        else:
+            self.engaged = np.zeros(self.soc.shape)
+        self.engaged = np.where(charging, 1.0, self.engaged)
+        grid_side, device_side = used - requested, stored - spent
+        if np.ndim(grid_side) == 0: # every device idle
+            grid_side, device_side = np.zeros(self.soc.shape), np.zeros(self.soc.shape)
+        return grid_side, device_side
+
+    def self_discharge(self) -> np.ndarray:
+        ''' Vectorized Storage._self_discharge, returns the energy lost by every device in Wh '''
+        delta_soc = np.minimum(self.self_discharge_rate() / 1000, self.soc - self.min_soc)
+        self.soc = self.soc - delta_soc
+        return delta_soc * self.cap
@@ -0,0 +1,248 @@
+''' Checks of the storage simulation against its reference paths, run with python -m pytest '''
+import copy
+import hashlib
+import json
+import shutil
+from math import e
+from pathlib import Path
+import numpy as np
+import pytest
+from Storage import (StorageSuite, CurveTable, CURVE_FORMULAS, SPEC_FORMULAS, CATALOG_CACHE_VERSION, compile_expr,
+                     fold_expr, load_device_data, load_device_catalog, _read_catalog_cache)
+
+DATA = Path(__file__).parent / 'data' / 'energy_storage_devices_v6.csv'
+
+@pytest.fixture
+def suite() -> StorageSuite:
+    return StorageSuite(filename=DATA, load=600_000)
+
+@pytest.mark.parametrize('device', ['li-ion', 'flywheel'])
+@pytest.mark.parametrize('soc', [1.0, 0.999, 0.95])
+@pytest.mark.parametrize('n_steps', [100, 5_000])
+def test_fast_forward_idle_matches_single_steps(suite, device, soc, n_steps):
+    stepped, forwarded = suite.storage_suite[device].fork(), suite.storage_suite[device].fork()
+    stepped.soc = forwarded.soc = soc
+    lost = sum(stepped._self_discharge() for _ in range(n_steps))
+    assert forwarded.fast_forward_idle(n_steps) == pytest.approx(lost, rel=1e-5)
+    assert forwarded.soc == pytest.approx(stepped.soc, abs=1e-9)
+
+@pytest.mark.parametrize('max_error', [1e-4, 1e-6])
+def test_curve_tables_meet_max_error(max_error):
+    suite = StorageSuite(filename=DATA, load=600_000, lut_max_error=max_error)
+    tables = 0
+    for device in suite.devices:
+        spec = device.spec
+        soc = np.linspace(spec.MIN_SOC, spec.MAX_SOC, 100_001)
+        for name in CURVE_FORMULAS:
+            table, formula = getattr(spec, 'array_' + name), getattr(spec, 'f_' + name)
+            if not isinstance(table, CurveTable): # a constant curve is kept as the formula
+                assert table is formula
+                continue
+            tables += 1
+            assert table.error <= max_error
+            exact = np.broadcast_to(formula(soc), soc.shape)
+            assert np.max(np.abs(table(soc) - exact)) <= 1.01 * max_error
+        rows = np.linspace(spec.MIN_SOC, spec.MAX_SOC, 64)
+        curves = device.evaluate_curves(rows)
+        assert curves['eff_charge'] == pytest.approx(spec.f_eff_charge(rows), abs=max_error)
+    assert tables == 4 # the three flywheel curves and the li-ion self-discharge
+
+def test_folded_formulas_match_the_data():
+    device_data = load_device_data(DATA)
+    for device, row in device_data.items():
+        for name in SPEC_FORMULAS:
+            formula = row[name].replace("'", "")
+            folded = compile_expr(row[name])
+            for x in ((0.05, 0.5, 1.0) if name in CURVE_FORMULAS else (1E3, 2E5)): # SoC or capacity
+                exact = eval(formula, {'__builtins__': {}, 'e': e}, {'x': x, 'y': x / 2})
+                assert folded(x, x / 2) == pytest.approx(exact, rel=1e-12), (device, name)
+            assert compile_expr(fold_expr(row[name]))(0.7, 0.3) == folded(0.7, 0.3)
+    assert compile_expr('(-2)**x')(2.0) == 4.0
+    assert compile_expr('2**-x')(1.0) == 0.5
+    with pytest.raises(TypeError):
+        compile_expr("__import__('os').getcwd()")
+
+def _spec_values(specs):
+    values = {}
+    for device, spec in specs.items():
+        soc = np.linspace(spec.MIN_SOC, spec.MAX_SOC, 11)
+        values[device] = ([spec.f_power(2E5), spec.f_peak_discharge(2E5, 1E5), spec.f_capital_cost(200, 100)]
+                          + [float(getattr(spec, 'f_' + name)(x)) for name in CURVE_FORMULAS for x in soc]
+                          + [spec.idle_rate] + [list(table) for table in spec.idle_table or ()])
+    return values
+
+def test_catalog_cache_round_trip(tmp_path):
+    filename = tmp_path / DATA.name
+    shutil.copyfile(DATA, filename)
+    cache_path = str(filename) + '.cache'
+    _, uncached = load_device_catalog(filename)
+    assert not Path(cache_path).exists() # caching is opt-in
+    _, written = load_device_catalog(filename, cache=True)
+    with open(filename, 'rb') as devices_file:
+        key = [CATALOG_CACHE_VERSION, hashlib.sha256(devices_file.read()).hexdigest()]
+    assert _read_catalog_cache(cache_path, key) is not None
+    _, cached = load_device_catalog(filename, cache=True)
+    assert _spec_values(cached) == _spec_values(written) == _spec_values(uncached)
+
+    with np.load(cache_path) as arrays: # a cache with a formula outside the grammar is ignored and rewritten
+        arrays = dict(arrays)
+    header = json.loads(str(arrays['header']))
+    header['sources']['li-ion']['capital_cost'] = "__import__('os').getcwd()"
+    arrays['header'] = np.array(json.dumps(header))
+    with open(cache_path, 'wb') as cache_file:
+        np.savez(cache_file, **arrays)
+    assert _read_catalog_cache(cache_path, key) is None
+    _, reloaded = load_device_catalog(filename, cache=True)
+    assert _spec_values(reloaded) == _spec_values(uncached)
+    assert _read_catalog_cache(cache_path, key) is not None
+
+def _step_devices(devices, power, dt=None):
+    ''' The per-device dispatch StorageSuite.dispatch and dispatch_interval replace '''
+    grid_side, device_side = [], []
+    for device, value in zip(devices, power):
+        if dt is None and value > 0:
+            used, stored = device._charge(power_used=value)
+        elif dt is None and value < 0:
+            used, stored = device._discharge(power_requested=-value)
+            used, stored = -used, -stored
+        elif dt is None:
+            used, stored = 0.0, 0.0
+        elif value >= 0:
+            used, stored = device.charge_interval(value, dt)
+        else:
+            used, stored = device.discharge_interval(-value, dt)
+            used, stored = -used, -stored
+        grid_side.append(used)
+        device_side.append(stored)
+    return grid_side, device_side
+
+@pytest.mark.parametrize('dt, scale', [(None, 2E4), (900, 4E4)])
+def test_dispatch_matches_storage_methods(suite, dt, scale):
+    devices = suite.fork().devices
+    rng = np.random.default_rng(0)
+    power = rng.uniform(-scale, scale, (500, len(devices))) * rng.integers(0, 2, (500, len(devices)))
+    for row in power:
+        if dt is None:
+            grid_side, device_side = suite.dispatch(row)
+        else:
+            grid_side, device_side = suite.dispatch_interval(row, dt)
+        expected_grid, expected_device = _step_devices(devices, row, dt)
+        assert grid_side == pytest.approx(expected_grid, rel=1e-12, abs=1e-9)
+        assert device_side == pytest.approx(expected_device, rel=1e-12, abs=1e-9)
+    for device, expected in zip(suite.devices, devices):
+        assert device.soc == pytest.approx(expected.soc, rel=1e-12)
+        assert device.peak_time == pytest.approx(expected.peak_time, rel=1e-12)
+        assert type(device.peak_time) is type(expected.peak_time)
+        assert device.engaged == expected.engaged
+
+SCHEDULE = [-3E3, -9E3, 0, 2E3, 8E3, 8E3, 0, 0, -5E3, -2E4, -2E4, 6E3, 0, -1E3] * 5 # net demand on the device, in Wh
+
+def _run_schedule(device_type, cap, tracked):
+    ''' Runs SCHEDULE through a single device suite, each command clamped by the device power and headroom as in
+        Microgrid.actions_agent; returns the energy delivered minus the energy used and the CapSensitivity '''
+    suite = StorageSuite(filename=DATA, load=cap, devices=[device_type])
+    device = suite.devices[0]
+    if tracked:
+        suite.track_sensitivity()
+    total = 0.0
+    for demand in SCHEDULE:
+        if demand == 0:
+            suite.self_discharge_all()
+            continue
+        capa = device.capa_to_charge if demand > 0 else device.capa_to_discharge
+        headroom = max(0, min(abs(demand), capa, device.power))
+        if tracked and headroom == device.power:
+            device.sensitivity.command(headroom, device.sensitivity.dpower(device))
+        elif tracked and headroom == capa and demand > 0:
+            device.sensitivity.command(headroom, device.sensitivity.dcapa_to_charge(device))
+        elif tracked and headroom == capa:
+            device.sensitivity.command(headroom, device.sensitivity.dcapa_to_discharge(device))
+        grid_side, _ = suite.dispatch([headroom if demand > 0 else -headroom])
+        total -= grid_side[0]
+    return total, device.sensitivity
+
+@pytest.mark.parametrize('device_type', ['li-ion', 'flywheel', 'flow'])
+@pytest.mark.parametrize('cap', [1E4, 2.5E4])
+def test_cap_sensitivity_matches_finite_differences(device_type, cap):
+    _, sensitivity = _run_schedule(device_type, cap, tracked=True)
+    step = 1e-4 * cap
+    finite = (_run_schedule(device_type, cap + step, False)[0] - _run_schedule(device_type, cap - step, False)[0]) / (2 * step)
+    assert sensitivity.drequested - sensitivity.dused == pytest.approx(finite, rel=1e-5, abs=1e-8)
+
+EPISODE_STEPS = 300
+
+@pytest.fixture
+def generated_microgrid():
+    ''' A microgrid of the baseline StorageSuite, from the pymgrid generator '''
+    mg = pytest.importorskip('pymgrid.MicrogridGenerator')
+    generator = mg.MicrogridGenerator(storage_suite_list=[StorageSuite(filename=DATA, load=600_000)])
+    generator.generate_microgrid(verbose=False)
+    return generator.microgrids[0]
+
+def _episode(env, actions):
+    states, rewards = [env.reset()], []
+    for action in actions:
+        state, reward, done = env.run(env.actions_agent(int(action)))
+        states.append(state)
+        rewards.append(reward)
+        if done:
+            break
+    return states, rewards
+
+def test_vec_microgrid_matches_microgrid(generated_microgrid):
+    from pymgrid.Microgrid import VecMicrogrid
+    rng = np.random.default_rng(1)
+    caps = rng.uniform(5E4, 4E5, (4, len(generated_microgrid.ss.devices)))
+    actions = rng.integers(0, 10, (EPISODE_STEPS, len(caps)))
+    vec = VecMicrogrid(generated_microgrid, caps=caps)
+    observations, rewards = [vec.reset()], []
+    for action in actions:
+        observation, reward, done = vec.step(action)
+        observations.append(observation)
+        rewards.append(reward)
+        if done.all():
+            break
+    for i, sizing in enumerate(caps):
+        generated_microgrid.ss.modify_ss(list(sizing))
+        states, expected = _episode(generated_microgrid, actions[:, i])
+        assert np.asarray(rewards)[:len(expected), i] == pytest.approx(expected, rel=1e-9, abs=1e-9)
+        assert np.allclose(np.asarray(observations)[1:len(states), i], states[1:], rtol=1e-6, equal_nan=True)
+
+def test_fork_matches_deepcopy(suite):
+    device = suite.storage_suite['flywheel']
+    device.track_sensitivity()
+    forked, copied = device.fork(), copy.deepcopy(device)
+    for value in [3E4, -4E4, 0, -2E4, 1E4] * 20:
+        for branch in (forked, copied):
+            if value > 0:
+                branch._charge(power_used=value)
+            elif value < 0:
+                branch._discharge(power_requested=-value)
+            else:
+                branch._self_discharge()
+    assert forked.save_state()[:3] == copied.save_state()[:3]
+    assert forked.sensitivity.dsoc == copied.sensitivity.dsoc
+    assert device.soc == 1 and device.sensitivity.dsoc == 0 # the forks do not touch the original
+    assert forked.spec is device.spec and copied.spec is device.spec
+
+def test_microgrid_fork_matches_deepcopy(generated_microgrid):
+    rng = np.random.default_rng(2)
+    actions = rng.integers(0, 10, EPISODE_STEPS)
+    env = generated_microgrid
+    _episode(env, actions[:100])
+    forked, copied = env.fork(), copy.deepcopy(env)
+    steps = env._tracking_timestep
+    branches = []
+    for branch in (forked, copied):
+        states, rewards = [], []
+        for action in actions[100:]:
+            state, reward, done = branch.run(branch.actions_agent(int(action)))
+            states.append(state)
+            rewards.append(reward)
+            if done:
+                break
+        branches.append((states, rewards, branch.total_cost, branch.total_co2))
+    (fork_states, *fork_rest), (copy_states, *copy_rest) = branches
+    assert fork_rest == copy_rest
+    assert all(np.array_equal(a, b, equal_nan=True) for a, b in zip(fork_states, copy_states))
+    assert env._tracking_timestep == steps # the branches do not touch the parent